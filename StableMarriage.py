@@ -1,12 +1,837 @@
+import collections.abc
+import concurrent.futures
+import csv
+import heapq
+import itertools
+import json
+import multiprocessing.shared_memory
+import os
+import statistics
+import time
 import numpy as np
 
+
+class CompiledPreferences:
+
+    """
+    An integer representation of a two-sided preference profile. It is built once per MarriageModel instance
+    (see MarriageModel.compile()) and is shared by every method that uses it.
+
+    The agents on each side are mapped to dense integers (side 0 is the proposing side and side 1 is the receiving
+    side) and their preference lists are stored as NumPy arrays together with the inverse rank tables, so that a
+    question such as "does r prefer p to p'" is answered by a constant-time array lookup instead of list.index().
+    Large profiles can be read straight into this form from delimited text files (from_csv()) or from .npy files
+    (from_npy()), and a compiled profile written to disk with save() is read back by load() without rebuilding it.
+
+    Attributes:
+
+    labels:       a 2-tuple of lists of the original agent labels of each side; the position of an agent in its list
+                  is its integer id
+    index:        a 2-tuple of Python dictionaries that map the labels of each side to their integer ids
+    preferences:  a 2-tuple of 2D integer arrays; row i is the preference list of agent i (in terms of the integer ids
+                  of the other side), padded with -1 at the end
+    lengths:      a 2-tuple of 1D integer arrays holding the length of every preference list
+    rank_tables:  a 2-tuple of 2D integer arrays; rank_tables[side][i, j] is the position of j on i's preference list
+                  (lower is better) and it is larger than every list length if j is not on i's list
+    """
+
+    # the arrays that hold the profile, one per side for each name (see save() and swapped())
+    _arrays = ('preferences', 'lengths', 'rank_tables')
+
+    def __init__(self, labels, preferences):
+        # labels is a 2-tuple of agent labels and preferences is a 2-tuple of lists of integer preference lists
+        tables = [self.__pad(lists) for lists in preferences]
+        self._set_tables(labels, tuple(table for table, _ in tables), tuple(lengths for _, lengths in tables))
+
+
+    # sets the labels of both sides and the integer ids derived from them
+    def _set_labels(self, labels):
+        self.labels = tuple(list(side) for side in labels)
+        self.index = tuple({agent: i for i, agent in enumerate(side)} for side in self.labels)
+        self.size = (len(self.labels[0]), len(self.labels[1]))
+
+
+    # sets the attributes from the labels and the padded preference arrays of both sides (and builds the rank tables)
+    def _set_tables(self, labels, preferences, lengths):
+        self._set_labels(labels)
+        self.preferences = tuple(preferences)
+        self.lengths = tuple(lengths)
+        self.rank_tables = tuple(self.__rank_table(side) for side in (0, 1))
+
+
+    # builds a compiled profile out of two preference profiles given as Python dictionaries
+    # (the same format MarriageModel accepts at initialization)
+    @classmethod
+    def from_profile(cls, proposers, receivers):
+
+        labels = (list(proposers), list(receivers))
+        index = tuple({agent: i for i, agent in enumerate(side)} for side in labels)
+
+        preferences = ([], [])
+        for side, (profile, name) in enumerate(((proposers, 'Proposer'), (receivers, 'Receiver'))):
+            # the preference lists of one side are written in terms of the agents of the other side
+            other_side = index[1 - side]
+            for agent, pref in profile.items():
+                # convert each preference list to a Python list if it is a singleton
+                if isinstance(pref, (str, int)):
+                    pref = [pref]
+                elif not isinstance(pref, list):
+                    raise ValueError("{} {}'s preference list is not a valid list.".format(name, agent))
+
+                try:
+                    pref_ids = list(map(other_side.__getitem__, pref))
+                # if the list could not be translated, find the entry that caused it and raise an error
+                except (KeyError, TypeError):
+                    for choice in pref:
+                        if isinstance(choice, list):
+                            raise TypeError("Preference lists must be strict. {} in {}'s preference list implies that {} is indifferent between them.".format(choice, agent, agent))
+                        if choice not in other_side:
+                            raise ValueError("{} {}'s preference list includes {}, who is not present in this problem."
+                                             .format(name, agent, choice))
+                    raise
+                # only the first occurrence of an agent on a list counts (as it does for list.index)
+                if len(set(pref_ids)) < len(pref_ids):
+                    pref_ids = list(dict.fromkeys(pref_ids))
+                preferences[side].append(pref_ids)
+
+        return cls(labels, preferences)
+
+
+    # builds a compiled profile out of the preference arrays of both sides: preferences[side][i] is the preference
+    # list of agent i written with the integer ids of the other side, padded with -1 at the end. int32 arrays are used
+    # as they are, so arrays memory-mapped from disk are not read into memory (only the rank tables are built in
+    # memory). the arrays are checked in blocks of rows so that the memory use stays bounded
+    @classmethod
+    def from_arrays(cls, labels, preferences, block_size=2**22):
+        labels = tuple(list(side) for side in labels)
+        preferences = tuple(table if isinstance(table, np.ndarray) and table.dtype == np.int32
+                            else np.asarray(table).astype(np.int32) for table in preferences)
+
+        lengths = []
+        for side, table in enumerate(preferences):
+            if table.ndim != 2 or len(table) != len(labels[side]):
+                raise ValueError('The preferences of each side must be a 2D array with a row for every agent.')
+            others = len(labels[1 - side])
+            side_lengths = np.zeros(len(table), dtype=np.int32)
+            rows = max(1, block_size // max(table.shape[1], 1))
+            for start in range(0, len(table), rows):
+                block = np.asarray(table[start:start + rows])
+                listed = block >= 0
+                if np.any((block >= others) | (block < -1)) or np.any(~listed[:, :-1] & listed[:, 1:]):
+                    raise ValueError('The preference lists must hold the ids of the other side, padded with -1 at '
+                                     'the end.')
+                side_lengths[start:start + len(block)] = listed.sum(axis=1)
+            lengths.append(side_lengths)
+
+        compiled = object.__new__(cls)
+        compiled._set_tables(labels, preferences, lengths)
+        # an agent who is listed twice on the same list keeps the rank of only one of the two entries
+        for side, table in enumerate(preferences):
+            rows = max(1, block_size // max(table.shape[1], 1))
+            for start in range(0, len(table), rows):
+                block = np.asarray(table[start:start + rows])
+                owners, positions = np.nonzero(block >= 0)
+                repeated = np.flatnonzero(compiled.rank(side, owners + start, block[owners, positions]) != positions)
+                if len(repeated) > 0:
+                    raise ValueError('Preference lists must be strict. {} lists an agent more than once.'
+                                     .format(labels[side][start + owners[repeated[0]]]))
+        return compiled
+
+
+    # builds a compiled profile out of two delimited text files (one per side) with a row per agent: the label of the
+    # agent followed by their preference list, from the most to the least preferred (agent,rank1,rank2,...). the files
+    # are read chunk_size rows at a time and every chunk is stored as an integer array right away, so the preference
+    # lists never exist as Python lists all at once. the labels are the strings in the files, and the agents keep the
+    # order of the rows
+    @classmethod
+    def from_csv(cls, proposers, receivers, delimiter=',', chunk_size=2**16):
+        # the agents on the lists get ids in the order they are first seen, since the rows of the other side may not
+        # have been read yet; the ids are translated to the order of the rows at the end
+        seen = ({}, {})
+        labels = ([], [])
+        blocks = ([], [])
+        for side, path in enumerate((proposers, receivers)):
+            other_side = seen[1 - side]
+            with open(path, newline='') as file:
+                reader = csv.reader(file, delimiter=delimiter)
+                for chunk in iter(lambda: list(itertools.islice(reader, chunk_size)), []):
+                    lists = []
+                    for row in chunk:
+                        row = list(filter(None, map(str.strip, row)))
+                        if not row:
+                            continue
+                        labels[side].append(row[0])
+                        try:
+                            lists.append(list(map(other_side.__getitem__, row[1:])))
+                        except KeyError:
+                            lists.append([other_side.setdefault(choice, len(other_side)) for choice in row[1:]])
+                    blocks[side].append(cls.__pad(lists)[0])
+
+        preferences = []
+        for side, name in ((0, 'proposer'), (1, 'receiver')):
+            index = {agent: i for i, agent in enumerate(labels[side])}
+            if len(index) < len(labels[side]):
+                agent = next(agent for i, agent in enumerate(labels[side]) if index[agent] != i)
+                raise ValueError('{} has more than one row in the {} file.'.format(agent, name))
+            missing = [agent for agent in seen[side] if agent not in index]
+            if missing:
+                raise ValueError('{} is on a preference list, but is not present in this problem.'.format(missing[0]))
+            order = np.array([index[agent] for agent in seen[side]] + [-1], dtype=np.int32)
+            # (the padding -1 is translated to order[-1] = -1)
+            width = max((block.shape[1] for block in blocks[1 - side]), default=0)
+            table = np.full((len(labels[1 - side]), width), -1, dtype=np.int32)
+            start = 0
+            for block in blocks[1 - side]:
+                table[start:start + len(block), :block.shape[1]] = order[block]
+                start += len(block)
+            preferences.append(table)
+
+        return cls.from_arrays(labels, preferences[::-1])
+
+
+    # builds a compiled profile out of two .npy files holding the preference arrays of both sides (see from_arrays()).
+    # the files are memory-mapped with the given mode (None reads them into memory). unless the labels of the sides
+    # are passed, the proposers are labelled with their integer ids and the receivers with their ids plus the number
+    # of proposers (so that no label is on both sides of a matching)
+    @classmethod
+    def from_npy(cls, proposers, receivers, proposer_labels=None, receiver_labels=None, mmap_mode='r'):
+        preferences = (np.load(proposers, mmap_mode=mmap_mode), np.load(receivers, mmap_mode=mmap_mode))
+        labels = (range(len(preferences[0])) if proposer_labels is None else proposer_labels,
+                  range(len(preferences[0]), len(preferences[0]) + len(preferences[1])) if receiver_labels is None
+                  else receiver_labels)
+        return cls.from_arrays(labels, preferences)
+
+
+    # writes the compiled profile to a directory: every array is a .npy file and the labels are kept in a JSON file,
+    # so the labels must be strings or integers. a directory is read back by load(), in the form that wrote it
+    def save(self, path):
+        for side in self.labels:
+            for agent in side:
+                if isinstance(agent, bool) or not isinstance(agent, (str, int)):
+                    raise ValueError('Only profiles labelled with strings and integers can be saved; {} is neither.'
+                                     .format(agent))
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'labels.json'), 'w') as file:
+            json.dump(self.labels, file)
+        for side in (0, 1):
+            for name in self._arrays:
+                np.save(os.path.join(path, '{}_{}.npy'.format(name, side)), getattr(self, name)[side])
+
+
+    # reads a compiled profile written by save(), as an instance of the class that wrote it (which is told by the
+    # arrays in the directory). the arrays are memory-mapped with the given mode (None reads them into memory) and
+    # nothing is rebuilt, so only the labels are read right away
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        for kind in (cls, CompiledPreferences, SparsePreferences):
+            if os.path.exists(os.path.join(path, '{}_0.npy'.format(kind._arrays[0]))):
+                cls = kind
+                break
+        with open(os.path.join(path, 'labels.json')) as file:
+            labels = json.load(file)
+        compiled = object.__new__(cls)
+        compiled._set_labels(labels)
+        for name in cls._arrays:
+            setattr(compiled, name, tuple(np.load(os.path.join(path, '{}_{}.npy'.format(name, side)),
+                                                  mmap_mode=mmap_mode) for side in (0, 1)))
+        return compiled
+
+
+    # returns the same profile with the proposing and the receiving side exchanged (no array is copied)
+    def swapped(self):
+        swapped = object.__new__(type(self))
+        for name in ('labels', 'index', 'size') + self._arrays:
+            setattr(swapped, name, getattr(self, name)[::-1])
+        return swapped
+
+
+    # stacks a list of integer lists into a 2D array padded with -1 and returns it with the length of each row
+    @staticmethod
+    def __pad(lists):
+        lengths = np.fromiter(map(len, lists), dtype=np.int32, count=len(lists))
+        width = int(lengths.max()) if len(lists) > 0 else 0
+        table = np.full((len(lists), width), -1, dtype=np.int32)
+        table[np.arange(width) < lengths[:, None]] = np.fromiter(itertools.chain.from_iterable(lists),
+                                                                 dtype=np.int32, count=int(lengths.sum()))
+        return table, lengths
+
+
+    # inverts the preference lists of one side into a rank table
+    # (the smallest integer type that can hold the ranks is used since these tables are n-by-m). the lists are
+    # processed in blocks of rows so that the index arrays stay small
+    def __rank_table(self, side, block_size=2**22):
+        preferences = self.preferences[side]
+        width = preferences.shape[1]
+        dtype = np.int16 if width < np.iinfo(np.int16).max else np.int32
+        table = np.full((self.size[side], self.size[1 - side]), np.iinfo(dtype).max, dtype=dtype)
+        rows = max(1, block_size // max(width, 1))
+        for start in range(0, self.size[side], rows):
+            block = np.asarray(preferences[start:start + rows])
+            owners, positions = np.nonzero(block >= 0)
+            table[owners + start, block[owners, positions]] = positions
+        return table
+
+
+    # returns every entry of the preference lists of one side as three flat arrays:
+    # the agent whose list it is, the position on that list and the agent at that position
+    def entries(self, side):
+        owners, positions = np.nonzero(np.arange(self.preferences[side].shape[1]) < self.lengths[side][:, None])
+        return owners, positions, self.preferences[side][owners, positions]
+
+
+    # returns the preference list of agent i on the given side as an array of integer ids
+    def choices(self, side, i):
+        return self.preferences[side][i, :self.lengths[side][i]]
+
+
+    # returns the agent at position k on i's preference list (works elementwise if i and k are arrays)
+    def choice(self, side, i, k):
+        return self.preferences[side][i, k]
+
+
+    # returns the position of j on i's preference list (works elementwise if i and j are arrays)
+    def rank(self, side, i, j):
+        return self.rank_tables[side][i, j]
+
+
+    # returns the rank every agent on the given side assigns to their partner in the passed partner array;
+    # being single ranks right after the last entry of the preference list, so an agent prefers j to their current
+    # situation if and only if rank(side, i, j) < current_ranks(side, partner)[i]
+    def current_ranks(self, side, partner):
+        ranks = self.lengths[side].astype(np.int64)
+        matched = np.flatnonzero(partner >= 0)
+        ranks[matched] = self.rank(side, matched, partner[matched])
+        return ranks
+
+
+    # returns, for every receiver with a capacity (the number of proposers they can be matched with), the rank a
+    # proposer has to beat to form a blocking pair with them given the partner array of the proposing side: a
+    # receiver who has room left accepts anyone on their list and a full receiver only accepts someone they prefer to
+    # the worst proposer they are matched with
+    def capacity_ranks(self, partner, capacities):
+        matched = np.flatnonzero(partner >= 0)
+        receivers = partner[matched]
+        worst = np.full(self.size[1], -1, dtype=np.int64)
+        np.maximum.at(worst, receivers, self.rank(1, receivers, matched).astype(np.int64))
+        full = np.bincount(receivers, minlength=self.size[1]) >= capacities
+        return np.where(full, worst, self.lengths[1])
+
+
+    # returns every blocking pair of the matching given by the partner arrays of both sides as two arrays
+    # (the proposers and the receivers of the blocking pairs, ordered by proposer and then by the proposer's ranking).
+    # a pair is blocking if the proposer ranks the receiver above their partner and the receiver ranks the proposer
+    # above theirs; the proposers' lists are processed in blocks of rows so that the memory use stays bounded.
+    # if receiver_ranks is passed, it replaces the ranks the receivers assign to their partners (see capacity_ranks())
+    def blocking_pairs(self, partners, block_size=2**22, receiver_ranks=None):
+        ranks = (self.current_ranks(0, partners[0]),
+                 self.current_ranks(1, partners[1]) if receiver_ranks is None else receiver_ranks)
+        width = self.preferences[0].shape[1]
+        rows = max(1, block_size // max(width, 1))
+
+        proposers, receivers = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for start in range(0, self.size[0], rows):
+            block = self.preferences[0][start:start + rows]
+            owners = np.arange(start, start + len(block))
+            # the receivers each proposer prefers to their partner,
+            owner, position = np.nonzero(np.arange(width) < np.minimum(ranks[0], self.lengths[0])[owners, None])
+            owner += start
+            target = block[owner - start, position]
+            # who prefer the proposer to their own partner
+            blocking = self.rank_tables[1][target, owner] < ranks[1][target]
+            proposers.append(owner[blocking])
+            receivers.append(target[blocking].astype(np.int64))
+
+        return np.concatenate(proposers), np.concatenate(receivers)
+
+
+    # converts a matching written with agent labels (a Python dictionary) into two partner arrays, one per side,
+    # where -1 denotes an unmatched agent. the arrays of a Matching on these preferences are copied as they are
+    def encode_matching(self, mu):
+        if isinstance(mu, Matching) and mu.compiled is self:
+            return tuple(partner.copy() for partner in mu.partners)
+        partners = (np.full(self.size[0], -1, dtype=np.int64), np.full(self.size[1], -1, dtype=np.int64))
+        for k, v in mu.items():
+            if v is None:
+                if k not in self.index[0] and k not in self.index[1]:
+                    raise ValueError('{} in the matching is not present on any preference lists.'.format(k))
+                continue
+            # married couples may be written in either direction
+            if k in self.index[0] and v in self.index[1]:
+                p, r = self.index[0][k], self.index[1][v]
+            elif k in self.index[1] and v in self.index[0]:
+                p, r = self.index[0][v], self.index[1][k]
+            else:
+                raise ValueError('{} and {} in the matching are not present on opposite sides of the preference lists.'
+                                 .format(k, v))
+            # nobody can be matched to two different partners
+            for side, agent, partner in ((0, p, r), (1, r, p)):
+                if partners[side][agent] not in (-1, partner):
+                    raise ValueError('This is not a matching. {} is matched with both {} and {} at the same time.'
+                                     .format(self.labels[side][agent], self.labels[1 - side][partners[side][agent]],
+                                             self.labels[1 - side][partner]))
+            partners[0][p], partners[1][r] = r, p
+        return partners
+
+
+    # converts an assignment of receivers with capacities written with agent labels (a Python dictionary that maps
+    # every receiver to a list of proposers) into the partner array of the proposing side, where -1 denotes an
+    # unmatched proposer
+    def encode_assignment(self, mu, capacities):
+        partner = np.full(self.size[0], -1, dtype=np.int64)
+        for k, v in mu.items():
+            if k in self.index[0]:
+                if v is not None:
+                    raise ValueError('{} is a proposer; the assignment must map receivers to lists of proposers.'
+                                     .format(k))
+                continue
+            if k not in self.index[1]:
+                raise ValueError('{} in the matching is not present on any preference lists.'.format(k))
+            r = self.index[1][k]
+            v = [] if v is None else v if isinstance(v, list) else [v]
+            if len(v) > capacities[r]:
+                raise ValueError('{} is matched with {} proposers, but their capacity is {}.'
+                                 .format(k, len(v), capacities[r]))
+            for proposer in v:
+                if proposer not in self.index[0]:
+                    raise ValueError('{} and {} in the matching are not present on opposite sides of the preference '
+                                     'lists.'.format(k, proposer))
+                p = self.index[0][proposer]
+                # nobody can be matched with two different receivers
+                if partner[p] not in (-1, r):
+                    raise ValueError('This is not a matching. {} is matched with both {} and {} at the same time.'
+                                     .format(proposer, self.labels[1][partner[p]], k))
+                partner[p] = r
+        return partner
+
+
+    # converts a partner array of the proposing side back into an assignment of receivers with capacities written
+    # with agent labels: every receiver is mapped to the list of their proposers (in the receiver's order of
+    # preference) and the unmatched proposers are mapped to None
+    def decode_assignment(self, partner):
+        proposers, receivers = self.labels
+        matched = np.flatnonzero(partner >= 0)
+        order = np.lexsort((self.rank(1, partner[matched], matched), partner[matched]))
+        mu = {r: [] for r in receivers}
+        for p in matched[order].tolist():
+            mu[receivers[partner[p]]].append(proposers[p])
+        mu.update({proposers[p]: None for p in np.flatnonzero(partner < 0).tolist()})
+        return mu
+
+
+    # converts a partner array of the proposing side back into a matching written with agent labels, in the format
+    # Deferred_Acceptance returns: proposers are the keys, and unmatched agents of both sides are matched to None.
+    # the matching is a Matching, which keeps the arrays and builds the items only when they are looked up
+    def decode_matching(self, partner):
+        return Matching(self, partner)
+
+
+class SparsePreferences(CompiledPreferences):
+
+    """
+    CompiledPreferences stored in compressed sparse rows, for problems in which the agents rank only a few agents of
+    the other side: the memory it takes is proportional to the total length of the preference lists, instead of the
+    number of agents on one side times the number of agents on the other. The ranks are looked up by binary search
+    in a sorted array of (agent, listed agent) keys instead of in a rank table.
+
+    Deferred_Acceptance() (with the 'rounds' engine), is_stable(), audit_stability() and random_path_to_stability()
+    work on it like on CompiledPreferences (see MarriageModel.compile()).
+
+    Attributes (labels, index, size and lengths are as in CompiledPreferences):
+
+    targets:    a 2-tuple of 1D int32 arrays holding the preference lists of each side one after the other
+    offsets:    a 2-tuple of 1D int64 arrays; the preference list of agent i is
+                targets[side][offsets[side][i]:offsets[side][i + 1]]
+    keys:       a 2-tuple of sorted 1D int64 arrays holding i * (number of agents on the other side) + j for every j on
+                the preference list of every agent i
+    key_ranks:  a 2-tuple of 1D int32 arrays; key_ranks[side][k] is the position of the entry keys[side][k] on its list
+    """
+
+    _arrays = ('targets', 'offsets', 'lengths', 'keys', 'key_ranks')
+    # the rank of an agent who is not on the list (larger than every list length)
+    unranked = np.iinfo(np.int32).max
+
+    def __init__(self, labels, preferences):
+        # labels is a 2-tuple of agent labels and preferences is a 2-tuple of lists of integer preference lists
+        lengths = [np.fromiter(map(len, lists), dtype=np.int32, count=len(lists)) for lists in preferences]
+        targets = [np.fromiter(itertools.chain.from_iterable(lists), dtype=np.int32, count=int(side_lengths.sum()))
+                   for lists, side_lengths in zip(preferences, lengths)]
+        self.__set_rows(labels, targets, lengths)
+
+
+    # sets the attributes from the labels and the padded preference arrays of both sides (see
+    # CompiledPreferences.from_arrays()); the padding is at the end of every row, so the listed entries of a block
+    # of rows in row order are the preference lists one after the other
+    def _set_tables(self, labels, preferences, lengths, block_size=2**22):
+        targets = []
+        for table in preferences:
+            rows = max(1, block_size // max(table.shape[1], 1))
+            blocks = [np.asarray(table[start:start + rows]) for start in range(0, len(table), rows)]
+            targets.append(np.concatenate([block[block >= 0] for block in blocks] + [np.zeros(0, dtype=np.int32)]))
+        self.__set_rows(labels, targets, lengths)
+
+
+    # sets the attributes from the labels and the flat preference lists of both sides
+    def __set_rows(self, labels, targets, lengths):
+        self._set_labels(labels)
+        self.targets = tuple(targets)
+        self.lengths = tuple(np.asarray(side_lengths, dtype=np.int32) for side_lengths in lengths)
+        self.offsets = tuple(np.concatenate(([0], np.cumsum(side_lengths, dtype=np.int64)))
+                             for side_lengths in self.lengths)
+
+        keys, key_ranks = [], []
+        for side in (0, 1):
+            owners, positions, targets = self.entries(side)
+            side_keys = owners * self.size[1 - side] + targets
+            # (a stable sort keeps the first entry first if an agent is listed twice, so that it is the one found)
+            order = np.argsort(side_keys, kind='stable')
+            keys.append(side_keys[order])
+            key_ranks.append(positions[order].astype(np.int32))
+        self.keys, self.key_ranks = tuple(keys), tuple(key_ranks)
+
+
+    # returns every entry of the preference lists of one side as three flat arrays (see CompiledPreferences.entries())
+    def entries(self, side):
+        owners = np.repeat(np.arange(self.size[side], dtype=np.int64), self.lengths[side])
+        positions = np.arange(len(owners), dtype=np.int64) - self.offsets[side][owners]
+        return owners, positions, self.targets[side].astype(np.int64)
+
+
+    def choices(self, side, i):
+        return self.targets[side][self.offsets[side][i]:self.offsets[side][i + 1]]
+
+
+    def choice(self, side, i, k):
+        return self.targets[side][self.offsets[side][i] + k]
+
+
+    def rank(self, side, i, j):
+        keys = self.keys[side]
+        key = np.asarray(i, dtype=np.int64) * self.size[1 - side] + j
+        if len(keys) == 0:
+            return np.full(np.shape(key), self.unranked)[()]
+        found = np.minimum(np.searchsorted(keys, key), len(keys) - 1)
+        return np.where(keys[found] == key, self.key_ranks[side][found], self.unranked)[()]
+
+
+    # returns every blocking pair of a matching (see CompiledPreferences.blocking_pairs()); the entries of the
+    # proposers' lists are processed in blocks so that the memory use stays bounded
+    def blocking_pairs(self, partners, block_size=2**22, receiver_ranks=None):
+        ranks = (self.current_ranks(0, partners[0]),
+                 self.current_ranks(1, partners[1]) if receiver_ranks is None else receiver_ranks)
+        offsets = self.offsets[0]
+
+        proposers, receivers = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for start in range(0, len(self.targets[0]), block_size):
+            entries = np.arange(start, min(start + block_size, len(self.targets[0])), dtype=np.int64)
+            owner = np.searchsorted(offsets, entries, side='right') - 1
+            # the receivers each proposer prefers to their partner,
+            preferred = entries - offsets[owner] < ranks[0][owner]
+            owner, target = owner[preferred], self.targets[0][entries[preferred]].astype(np.int64)
+            # who prefer the proposer to their own partner
+            blocking = self.rank(1, target, owner) < ranks[1][target]
+            proposers.append(owner[blocking])
+            receivers.append(target[blocking])
+
+        return np.concatenate(proposers), np.concatenate(receivers)
+
+
+class ProfileView(collections.abc.Mapping):
+
+    """
+    A read-only view of one side of a compiled profile as a preference profile (a dictionary that maps every agent
+    to their preference list, written with agent labels). The lists are built when they are looked up, so a model
+    made from compiled preferences (see MarriageModel.from_compiled()) does not hold them all as Python lists.
+    """
+
+    def __init__(self, compiled, side):
+        self.compiled = compiled
+        self.side = side
+
+
+    def __getitem__(self, agent):
+        compiled, side = self.compiled, self.side
+        return [compiled.labels[1 - side][j] for j in compiled.choices(side, compiled.index[side][agent]).tolist()]
+
+
+    def __contains__(self, agent):
+        return agent in self.compiled.index[self.side]
+
+
+    def __iter__(self):
+        return iter(self.compiled.labels[self.side])
+
+
+    def __len__(self):
+        return self.compiled.size[self.side]
+
+
+    # a copy is a Python dictionary (as for the profiles passed to MarriageModel)
+    def copy(self):
+        return dict(self.items())
+
+
+class Matching(collections.abc.Mapping):
+
+    """
+    A one-to-one matching on compiled preferences, kept as the partner arrays of both sides. It is a read-only
+    mapping with the items of the dictionary Deferred_Acceptance() returns: every proposer is a key mapped to their
+    partner (None if unmatched), followed by the unmatched receivers mapped to None. The items are built from the
+    arrays when they are looked up, so no dictionary is made unless one is asked for (see copy()).
+
+    Attributes:
+
+    compiled:  the CompiledPreferences the matching is on
+    partners:  a 2-tuple of 1D int64 arrays; partners[0][p] is the receiver proposer p is matched with and
+               partners[1][r] the proposer receiver r is matched with (-1 if unmatched)
+    """
+
+    # partner is the partner array of the proposing side; it is copied, so the matching does not change with it
+    def __init__(self, compiled, partner):
+        partner = np.array(partner, dtype=np.int64)
+        receivers = np.full(compiled.size[1], -1, dtype=np.int64)
+        matched = np.flatnonzero(partner >= 0)
+        receivers[partner[matched]] = matched
+        self.compiled = compiled
+        self.partners = (partner, receivers)
+
+
+    def __getitem__(self, agent):
+        compiled = self.compiled
+        if agent in compiled.index[0]:
+            r = self.partners[0][compiled.index[0][agent]]
+            return compiled.labels[1][r] if r >= 0 else None
+        # only the unmatched receivers are keys
+        if agent in compiled.index[1] and self.partners[1][compiled.index[1][agent]] < 0:
+            return None
+        raise KeyError(agent)
+
+
+    def __iter__(self):
+        yield from self.compiled.labels[0]
+        receivers = self.compiled.labels[1]
+        yield from (receivers[r] for r in np.flatnonzero(self.partners[1] < 0).tolist())
+
+
+    def __len__(self):
+        return self.compiled.size[0] + int(np.count_nonzero(self.partners[1] < 0))
+
+
+    # two matchings on the same compiled preferences are compared through their arrays
+    def __eq__(self, other):
+        if isinstance(other, Matching) and other.compiled is self.compiled:
+            return np.array_equal(self.partners[0], other.partners[0])
+        return super().__eq__(other)
+
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+    # a copy is a Python dictionary (the format Deferred_Acceptance() returns for models that are not compiled)
+    def copy(self):
+        return dict(self.items())
+
+
+    def partner_of(self, agent):
+        """
+        Returns the partner of an agent of either side (None if the agent is unmatched).
+        """
+        compiled = self.compiled
+        for side in (0, 1):
+            if agent in compiled.index[side]:
+                partner = self.partners[side][compiled.index[side][agent]]
+                return compiled.labels[1 - side][partner] if partner >= 0 else None
+        raise ValueError('{} is not present in this problem.'.format(agent))
+
+
+    def pairs(self):
+        """
+        Returns the matched pairs as a list of (proposer, receiver) tuples, in the order of the proposers.
+        """
+        proposers, receivers = self.compiled.labels
+        matched = np.flatnonzero(self.partners[0] >= 0)
+        return [(proposers[p], receivers[r]) for p, r in zip(matched.tolist(), self.partners[0][matched].tolist())]
+
+
+    def unmatched(self, side=0):
+        """
+        Returns the list of the unmatched agents of the given side (0 for the proposers, 1 for the receivers).
+        """
+        labels = self.compiled.labels[side]
+        return [labels[a] for a in np.flatnonzero(self.partners[side] < 0).tolist()]
+
+
+    def ranks(self, side=0):
+        """
+        Returns an array with the rank every agent of the given side (0 for the proposers, 1 for the receivers)
+        assigns to their partner, where 0 is the first choice and an unmatched agent ranks their situation right
+        after the last entry of their preference list.
+        """
+        return self.compiled.current_ranks(side, self.partners[side])
+
+
+    def rank_statistics(self):
+        """
+        Summarizes the ranks the matched agents assign to their partners (see ranks()).
+
+        Output: A Python dictionary with the following keys:
+        - 'number_of_pairs': the number of matched pairs
+        - 'proposer_rank_sum', 'receiver_rank_sum': the sum of the ranks of the matched agents of each side
+        - 'proposer_mean_rank', 'receiver_mean_rank': the mean rank of the matched agents of each side (nan if no one
+                                                      is matched)
+        - 'egalitarian_cost': the sum of the ranks of all matched agents
+        - 'regret': the largest rank any matched agent assigns to their partner (-1 if no one is matched)
+        """
+        matched = [self.ranks(side)[self.partners[side] >= 0] for side in (0, 1)]
+        sums = [int(ranks.sum(dtype=np.int64)) for ranks in matched]
+        number_of_pairs = len(matched[0])
+        return {'number_of_pairs': number_of_pairs,
+                'proposer_rank_sum': sums[0],
+                'receiver_rank_sum': sums[1],
+                'proposer_mean_rank': sums[0] / number_of_pairs if number_of_pairs else float('nan'),
+                'receiver_mean_rank': sums[1] / number_of_pairs if number_of_pairs else float('nan'),
+                'egalitarian_cost': sums[0] + sums[1],
+                'regret': int(max(matched[0].max(), matched[1].max())) if number_of_pairs else -1}
+
+
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%% INSTRUMENTATION %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+# what an observer (see MarriageModel.Deferred_Acceptance() and random_path_to_stability()) receives after every round:
+# the number of the round, the number of proposals made in it and of proposals rejected in it, the number of free
+# proposers who propose in the next round and the wall time the round took (in seconds). a step of a random path
+# to stability is a round in which the blocking pair is the one proposal and the partners it leaves are the rejections
+RoundEvent = collections.namedtuple('RoundEvent', ['round', 'proposals', 'rejections', 'free_proposers', 'seconds'])
+
+# the totals of the last run of Deferred_Acceptance() or random_path_to_stability(), stored in MarriageModel.stats.
+# rounds are counted as print_rounds counts them (summed over the paths of random_path_to_stability())
+RunStats = collections.namedtuple('RunStats', ['method', 'engine', 'rounds', 'proposals', 'rejections', 'seconds'])
+
+
+class RoundRecorder:
+
+    """
+    An observer that keeps every RoundEvent it receives in self.events.
+    """
+
+    def __init__(self):
+        self.events = []
+
+
+    def __call__(self, event):
+        self.events.append(event)
+
+
+    # returns the recorded events as a Python dictionary of arrays, one per field of RoundEvent
+    def as_arrays(self):
+        return {field: np.array([getattr(event, field) for event in self.events]) for field in RoundEvent._fields}
+
+
+class JSONLinesLogger:
+
+    """
+    An observer that writes every RoundEvent it receives to a file-like object as a line of JSON.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+
+    def __call__(self, event):
+        self.stream.write(json.dumps(event._asdict()) + '\n')
+
+
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+
 class MarriageModel:
-    
-    def __init__(self, proposers, receivers):
-        # initialize 
+
+    def __init__(self, proposers, receivers, compiled=False, capacities=None):
+        # initialize
         self.proposers = proposers
         self.receivers = receivers
-        
+        # the number of proposers each receiver can be matched with (a Python dictionary); receivers who are not in
+        # it can be matched with one proposer. None means that the problem is one-to-one
+        if capacities is not None:
+            for k, v in capacities.items():
+                if k not in receivers:
+                    raise ValueError('{} in capacities is not a receiver in this problem.'.format(k))
+                if isinstance(v, bool) or not isinstance(v, (int, np.integer)) or v < 0:
+                    raise ValueError("{}'s capacity is not a non-negative integer.".format(k))
+        self.capacities = capacities
+        # the compiled (integer) form of the preferences is opt-in; it is built by compile() (in sparse form if
+        # compiled is 'sparse')
+        self.compiled = None
+        # the state the last run of the queue engine ended in, and whether the problem has changed since then
+        # (see add_proposer() and the other methods that change the problem)
+        self.__engine_state = None
+        self.__changed = False
+        self.proposals_saved = 0
+        # the RunStats of the last run of Deferred_Acceptance() or random_path_to_stability()
+        self.stats = None
+        if compiled:
+            self.compile(sparse=compiled == 'sparse')
+
+
+    def compile(self, sparse=False):
+        """
+        Builds the compiled form of the preference profiles passed at class instance initialization (a
+        CompiledPreferences instance), stores it in self.compiled and returns it.
+
+        Once a model is compiled, Deferred_Acceptance(), is_stable() and random_path_to_stability() work on integer
+        arrays and constant-time rank lookups instead of the preference dictionaries; their outputs are still written
+        with the original agent labels. The compiled form is built once; call compile() again if the preference
+        dictionaries are modified afterwards.
+
+        If sparse is True, the compiled form is a SparsePreferences instance, whose memory use is proportional to the
+        total length of the preference lists rather than to the number of possible pairs. The queue engine, receiver
+        capacities in Deferred_Acceptance() and the methods based on rotations need the rank tables of the dense form.
+        """
+        self.compiled = (SparsePreferences if sparse else CompiledPreferences).from_profile(self.proposers,
+                                                                                          self.receivers)
+        self.__engine_state = None
+        return self.compiled
+
+
+    # raises an error if the model is compiled in sparse form, for the methods that need the rank tables
+    def __require_rank_tables(self, name):
+        if isinstance(self.compiled, SparsePreferences):
+            raise ValueError('{} cannot run on the sparse compiled preferences; call compile() first.'
+                             .format(name))
+
+
+    @classmethod
+    def from_compiled(cls, compiled, capacities=None):
+        """
+        Builds a model out of a CompiledPreferences instance, e.g. one read with CompiledPreferences.from_csv(),
+        from_npy() or load(), without building the preference dictionaries: self.proposers and self.receivers are
+        read-only views of the compiled preferences (see ProfileView) and self.compiled is the passed instance.
+        """
+        model = cls(ProfileView(compiled, 0), ProfileView(compiled, 1), capacities=capacities)
+        model.compiled = compiled
+        return model
+
+
+    def save_compiled(self, path):
+        """
+        Writes the compiled preferences (compiling them first if needed) to the directory at path, from which
+        load_compiled() builds the model again without compiling.
+        """
+        (self.compiled if self.compiled is not None else self.compile()).save(path)
+
+
+    @classmethod
+    def load_compiled(cls, path, capacities=None, mmap_mode='r'):
+        """
+        Builds a model out of compiled preferences written by save_compiled(), in the form they were written in (dense
+        or sparse). The arrays are memory-mapped with the given mode (see numpy.load; None reads them into memory), so
+        the model is ready as soon as the labels are read.
+        """
+        return cls.from_compiled(CompiledPreferences.load(path, mmap_mode), capacities)
+
     #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
     #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%% HELPER FUNCTIONS %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
     #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
@@ -22,7 +847,7 @@ class MarriageModel:
         if set(PrefLists) == set(mu):
             return False
         # there is no rejection if every proposer is at the end of their list
-        elif sum(0 if recent_proposals[p] == PrefLists[p][-1] else 1 for p in set(PrefLists).difference(set(mu))) is 0:
+        elif sum(0 if recent_proposals[p] == PrefLists[p][-1] else 1 for p in set(PrefLists).difference(set(mu))) == 0:
             return False
         # if there is rejection, iterate
         else:
@@ -41,7 +866,7 @@ class MarriageModel:
     def sort_matching(mu, keys=None):
         
         # sort the matches either by receivers or proposers
-        if isinstance(mu, dict):
+        if isinstance(mu, collections.abc.Mapping):
             # separate the singles from the married couples 
             # they will be appended at the end of mu
             singles = sorted([(str(k), 'unmatched') for k,v in mu.items() if v is None])
@@ -123,7 +948,7 @@ class MarriageModel:
             
             # if randomize=True, then shuffle the list of singles
             if kwargs.get('randomize') is True:
-                np.random.shuffle(singles)
+                kwargs.get('rng', np.random).shuffle(singles)
             
             # if Preferences are not passed, use the initialized preferences
             if Preferences is None:
@@ -156,7 +981,7 @@ class MarriageModel:
                 
                 # randomize the order of the list of preferred receivers if randomize is True
                 if kwargs.get('randomize') is True:
-                    np.random.shuffle(would_rather_match)
+                    kwargs.get('rng', np.random).shuffle(would_rather_match)
 
                 # look for a blocking pair,
                 blocking_pair = self.__is_blocking_pair(person, would_rather_match, pref_lists, marriages)
@@ -201,7 +1026,7 @@ class MarriageModel:
 
                 # randomize the order of the list of preferred women if randomize is True
                 if kwargs.get('randomize') is True:
-                    np.random.shuffle(better_than_partner)
+                    kwargs.get('rng', np.random).shuffle(better_than_partner)
 
                 # look for a blocking pair,
                 blocking_pair = self.__is_blocking_pair(spouse1, better_than_partner, Preferences[1], married_reverse)
@@ -222,7 +1047,284 @@ class MarriageModel:
     #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
     #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%% DEFERRED ACCEPTANCE %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
     #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
-    
+
+    # sends the RoundEvent of a round that ended now and started at the given time to the observer, and returns the
+    # time it ended at (the start of the next round)
+    @staticmethod
+    def __observe(observer, started, *event):
+        ended = time.perf_counter()
+        observer(RoundEvent(*event, ended - started))
+        return ended
+
+
+    # one round of the Gale-Shapley algorithm on the compiled preferences
+    # every proposer in free proposes to the next option on their preference list (next_choice points to it), and
+    # every receiver keeps the best among the proposals they received and the proposal they were holding.
+    # it returns the proposers who were rejected in this round (including those who were holding before).
+    # if workers (a _RoundWorkers) are passed, the receivers resolve their proposals in the worker processes
+    def __compiled_round(self, free, next_choice, holder, holder_rank, workers=None):
+        compiled = self.compiled
+
+        # (i) only those who are not at the end of their list can propose
+        free = free[next_choice[free] < compiled.lengths[0][free]]
+        pointed = compiled.choice(0, free, next_choice[free])
+        next_choice[free] += 1
+
+        # (a round with few proposals is not worth sending to the workers)
+        if workers is not None and len(free) >= workers.min_proposals:
+            return workers.resolve(free, pointed)
+        return self.__resolve_proposals(compiled, free, pointed, holder, holder_rank)
+
+
+    # the receivers' side of a round: free[i] proposes to pointed[i], and every receiver who received a proposal
+    # keeps the best among them and the proposal they were holding (updating holder and holder_rank). it returns the
+    # proposers who were rejected, who are never more than the proposals. only the entries of holder and holder_rank
+    # of the receivers in pointed are read or written, so that the receivers can be split among worker processes
+    @staticmethod
+    def __resolve_proposals(compiled, free, pointed, holder, holder_rank):
+
+        # proposers who are not on the receiver's preference list are rejected right away
+        rank = compiled.rank(1, pointed, free)
+        acceptable = rank < compiled.lengths[1][pointed]
+        rejected = free[~acceptable]
+        free, pointed, rank = free[acceptable], pointed[acceptable], rank[acceptable]
+
+        # (ii) combine the new and holding proposals for each receiver who received a new proposal
+        holding = np.unique(pointed)
+        holding = holding[holder[holding] >= 0]
+        candidates = np.concatenate((free, holder[holding]))
+        receivers = np.concatenate((pointed, holding))
+        ranks = np.concatenate((rank, holder_rank[holding]))
+
+        # (iii) every receiver keeps the best proposal according to their preferences and reject all others
+        # (sorting by receiver and then by rank puts each receiver's best proposal first in its group)
+        order = np.lexsort((ranks, receivers))
+        candidates, receivers, ranks = candidates[order], receivers[order], ranks[order]
+        best = np.ones(len(receivers), dtype=bool)
+        best[1:] = receivers[1:] != receivers[:-1]
+        holder[receivers[best]] = candidates[best]
+        holder_rank[receivers[best]] = ranks[best]
+
+        return np.concatenate((rejected, candidates[~best]))
+
+
+    # Deferred Acceptance on the compiled preferences
+    # (the rounds are counted the same way as in the dictionary-based implementation below).
+    # with the parallel engine, holder and holder_rank live in the shared memory of the worker processes, which
+    # resolve the proposals of each round for their own block of receivers
+    def __compiled_deferred_acceptance(self, **kwargs):
+        compiled = self.compiled
+        if kwargs.get('engine') == 'parallel':
+            with _RoundWorkers(compiled, kwargs.get('n_jobs')) as workers:
+                return self.__compiled_rounds(workers.holder, workers.holder_rank, workers, **kwargs)
+        return self.__compiled_rounds(np.full(compiled.size[1], -1, dtype=np.int64),
+                                      np.zeros(compiled.size[1], dtype=np.int64), **kwargs)
+
+
+    def __compiled_rounds(self, holder, holder_rank, workers=None, **kwargs):
+        compiled = self.compiled
+        observer = kwargs.get('observer')
+        start = started = time.perf_counter()
+
+        next_choice = np.zeros(compiled.size[0], dtype=np.int64)
+
+        # the first round: every proposer proposes to their first choice
+        itr = 1
+        free = self.__compiled_round(np.arange(compiled.size[0]), next_choice, holder, holder_rank, workers)
+        if observer is not None:
+            proposing = int(np.count_nonzero(next_choice[free] < compiled.lengths[0][free]))
+            started = self.__observe(observer, started, itr, int(np.count_nonzero(compiled.lengths[0])), len(free),
+                                     proposing)
+
+        # iterate while there exist rejections
+        rejections_exist = True
+        while rejections_exist:
+
+            if kwargs.get('print_tentative_matchings') is True:
+                print('Tentative matching after Round {}:'.format(itr))
+                print({compiled.labels[0][p]: compiled.labels[1][r] for r, p in enumerate(holder.tolist()) if p >= 0})
+
+            free = self.__compiled_round(free, next_choice, holder, holder_rank, workers)
+            # there is rejection if a rejected proposer is not at the end of their list
+            rejections_exist = bool(np.any(next_choice[free] < compiled.lengths[0][free]))
+
+            itr += 1
+            if observer is not None:
+                proposed, proposing = proposing, int(np.count_nonzero(next_choice[free] < compiled.lengths[0][free]))
+                started = self.__observe(observer, started, itr, proposed, len(free), proposing)
+
+        if kwargs.get('print_rounds') is True:
+            print('Success. The Gale-Shapley algorithm ran {} rounds.'.format(itr))
+
+        # every proposal is either held at the end or rejected
+        proposals = int(next_choice.sum())
+        self.stats = RunStats('Deferred_Acceptance', 'rounds' if workers is None else 'parallel', itr, proposals,
+                              proposals - int(np.count_nonzero(holder >= 0)), time.perf_counter() - start)
+        return compiled.decode_matching(self.__holder_to_partner(holder, compiled.size[0]))
+
+
+    # Deferred Acceptance with a stack of free proposers, a pointer to the next option on each proposer's list and
+    # the proposer each receiver currently holds; every entry of every preference list is looked at most once.
+    # the free proposers are processed in generations (everyone who is rejected while the current stack is emptied
+    # proposes in the next generation), so that a generation corresponds to a round of the other implementations.
+    # the state the run ends in is saved, together with the cause of every rejection: causes[h] lists the proposals
+    # (proposer, position on their list) that were rejected because of h's proposal at a given position on h's list.
+    # if warm_start is True, the run starts from the saved state instead of from scratch
+    def __queue_deferred_acceptance(self, warm_start=False, **kwargs):
+        compiled = self.compiled
+        observer = kwargs.get('observer')
+        start = started = time.perf_counter()
+        preferences, rank_table = compiled.preferences[0], compiled.rank_tables[1]
+        lengths, receiver_lengths = compiled.lengths[0].tolist(), compiled.lengths[1].tolist()
+
+        if warm_start:
+            next_choice, holder, causes = self.__engine_state
+        else:
+            next_choice = [0] * compiled.size[0]
+            holder = [-1] * compiled.size[1]
+            causes = [[] for _ in range(compiled.size[0])]
+        # every proposal that has already been made is one that does not have to be made again
+        self.proposals_saved = sum(next_choice)
+        held = [False] * compiled.size[0]
+        for p in holder:
+            if p >= 0:
+                held[p] = True
+        held_at_start = sum(held)
+        # the stack is popped from the end, so the proposers are reversed to let them propose in order
+        free = [p for p in reversed(range(compiled.size[0])) if not held[p] and next_choice[p] < lengths[p]]
+
+        rounds = 0
+        while free:
+
+            rounds += 1
+            proposing = len(free)
+            rejected = []
+            while free:
+                p = free.pop()
+                # p proposes to the next option on their preference list
+                r = preferences.item(p, next_choice[p])
+                next_choice[p] += 1
+                rank = rank_table.item(r, p)
+                # r rejects p if p is not on r's preference list,
+                if rank >= receiver_lengths[r]:
+                    rejected.append(p)
+                # holds onto p if r was not holding anyone,
+                elif holder[r] < 0:
+                    holder[r] = p
+                # holds onto p and rejects the proposer r was holding if r prefers p,
+                elif rank < rank_table.item(r, holder[r]):
+                    h = holder[r]
+                    causes[p].append((next_choice[p] - 1, h, next_choice[h] - 1))
+                    rejected.append(h)
+                    holder[r] = p
+                # and rejects p otherwise
+                else:
+                    h = holder[r]
+                    causes[h].append((next_choice[h] - 1, p, next_choice[p] - 1))
+                    rejected.append(p)
+
+            if kwargs.get('print_tentative_matchings') is True:
+                print('Tentative matching after Round {}:'.format(rounds))
+                print({compiled.labels[0][p]: compiled.labels[1][r] for r, p in enumerate(holder) if p >= 0})
+
+            # only the rejected proposers who are not at the end of their list propose in the next round
+            free = [p for p in reversed(rejected) if next_choice[p] < lengths[p]]
+            if observer is not None:
+                started = self.__observe(observer, started, rounds, proposing, len(rejected), len(free))
+
+        # the other implementations always run at least one round after the first one (in which they find out that
+        # there are no rejections), so a single round is counted as two to keep the counts comparable
+        if kwargs.get('print_rounds') is True:
+            print('Success. The Gale-Shapley algorithm ran {} rounds.'.format(max(rounds, 2)))
+
+        # every proposal made in this run and every proposal held at its start is either held at the end or rejected
+        proposals = sum(next_choice) - self.proposals_saved
+        rejections = proposals + held_at_start - sum(1 for p in holder if p >= 0)
+        self.stats = RunStats('Deferred_Acceptance', 'queue', max(rounds, 2), proposals, rejections,
+                              time.perf_counter() - start)
+        self.__engine_state = (next_choice, holder, causes)
+        self.__changed = False
+        return compiled.decode_matching(self.__holder_to_partner(np.array(holder, dtype=np.int64), compiled.size[0]))
+
+
+    # returns the capacity of every receiver as an array (in the order of the compiled receivers)
+    def __capacity_array(self):
+        receivers = self.compiled.labels[1]
+        return np.array([self.capacities.get(r, 1) for r in receivers], dtype=np.int64)
+
+
+    # Deferred Acceptance for receivers with capacities, with a stack of free proposers as in the queue engine.
+    # every receiver holds the proposers they have not rejected yet in a heap bounded by their capacity and keyed by
+    # rank, so that the worst proposer they hold is found in constant time and replaced in logarithmic time
+    def __capacitated_deferred_acceptance(self, **kwargs):
+        compiled = self.compiled
+        observer = kwargs.get('observer')
+        start = started = time.perf_counter()
+        preferences, rank_table = compiled.preferences[0], compiled.rank_tables[1]
+        lengths, receiver_lengths = compiled.lengths[0].tolist(), compiled.lengths[1].tolist()
+        capacities = self.__capacity_array().tolist()
+
+        next_choice = [0] * compiled.size[0]
+        # the heaps hold (-rank, proposer) pairs, so that the worst proposer is on top
+        held = [[] for _ in range(compiled.size[1])]
+        free = [p for p in reversed(range(compiled.size[0])) if lengths[p] > 0]
+
+        rounds = 0
+        while free:
+
+            rounds += 1
+            proposing = len(free)
+            rejected = []
+            while free:
+                p = free.pop()
+                # p proposes to the next option on their preference list
+                r = preferences.item(p, next_choice[p])
+                next_choice[p] += 1
+                rank = rank_table.item(r, p)
+                # r rejects p if p is not on r's preference list,
+                if rank >= receiver_lengths[r]:
+                    rejected.append(p)
+                # holds onto p if r has room left,
+                elif len(held[r]) < capacities[r]:
+                    heapq.heappush(held[r], (-rank, p))
+                # holds onto p and rejects the worst proposer r was holding if r prefers p to them,
+                elif held[r] and rank < -held[r][0][0]:
+                    rejected.append(heapq.heapreplace(held[r], (-rank, p))[1])
+                # and rejects p otherwise
+                else:
+                    rejected.append(p)
+
+            if kwargs.get('print_tentative_matchings') is True:
+                print('Tentative matching after Round {}:'.format(rounds))
+                print({compiled.labels[1][r]: [compiled.labels[0][p] for _, p in sorted(heap, reverse=True)]
+                       for r, heap in enumerate(held) if heap})
+
+            # only the rejected proposers who are not at the end of their list propose in the next round
+            free = [p for p in reversed(rejected) if next_choice[p] < lengths[p]]
+            if observer is not None:
+                started = self.__observe(observer, started, rounds, proposing, len(rejected), len(free))
+
+        # (rounds are counted as in the queue engine)
+        if kwargs.get('print_rounds') is True:
+            print('Success. The Gale-Shapley algorithm ran {} rounds.'.format(max(rounds, 2)))
+
+        proposals = sum(next_choice)
+        self.stats = RunStats('Deferred_Acceptance', 'capacitated', max(rounds, 2), proposals,
+                              proposals - sum(map(len, held)), time.perf_counter() - start)
+        partner = np.full(compiled.size[0], -1, dtype=np.int64)
+        for r, heap in enumerate(held):
+            partner[[p for _, p in heap]] = r
+        return compiled.decode_assignment(partner)
+
+
+    # reverses an array of the proposer each receiver holds into an array of the receiver each proposer is matched to
+    @staticmethod
+    def __holder_to_partner(holder, number_of_proposers):
+        partner = np.full(number_of_proposers, -1, dtype=np.int64)
+        partner[holder[holder >= 0]] = np.flatnonzero(holder >= 0)
+        return partner
+
+
     def Deferred_Acceptance(self, **kwargs):
         """
         A method that implements Gale and Shapley's Deferred Acceptance algorithm using the preference profiles 
@@ -236,14 +1338,78 @@ class MarriageModel:
         (Optional) key-word arguments: 
         print_rounds: If True, prints the number of steps it took to reach the final outcome.
         print_tentative_matchings: If True, prints all tentative matchings made after each step.
-        
-        Returns a dictionary where: 
-        - For married couples: the keys correspond to the proposers and 
+        engine: Either 'rounds' (default), 'queue' or 'parallel'.
+                'rounds' lets every rejected proposer propose at once in each round.
+                'queue' keeps a stack of free proposers, a pointer to the next option of each proposer and the
+                proposer each receiver holds, so that it runs in time linear in the total length of the preference
+                lists. It compiles the model (see compile()) if it is not compiled yet.
+                'parallel' runs the rounds of 'rounds' with the receivers split among n_jobs worker processes: the
+                receivers' preference arrays and what every receiver holds are kept in shared memory, and in every
+                round with enough proposals each worker decides which proposals its receivers keep. It compiles
+                the model if it is not compiled yet. It pays off on large markets (of about 100,000 agents or more).
+                All engines return the same matching and count rounds the same way.
+        n_jobs: The number of worker processes of the 'parallel' engine. Default is the number of CPUs.
+        observer: A callable that receives a RoundEvent after every round (the proposals and rejections made in it,
+                  the number of free proposers who propose next and the wall time it took), e.g. a RoundRecorder or
+                  a JSONLinesLogger. Nothing is reported if it is not passed.
+
+        Returns a dictionary where:
+        - For married couples: the keys correspond to the proposers and
                                the values correspond to the receivers
         - For singles: the keys are the names of single people and the values are None
+
+        If capacities were passed at class instance initialization, every receiver holds as many proposers as their
+        capacity (whatever the engine). The model is compiled if it is not compiled yet, and the returned dictionary
+        maps every receiver to the list of proposers they are matched with (in the receiver's order of preference)
+        and every unmatched proposer to None.
+
+        If the model is compiled (see compile()), the algorithm runs on the compiled preferences and returns the same
+        matching as a Matching: a read-only mapping with the same items, which also keeps the partners of both sides
+        as arrays (see Matching; its copy() is a Python dictionary).
+
+        After a change to the problem (see add_proposer(), remove_proposer(), add_receiver(), remove_receiver() and
+        update_preferences()), a model whose last run used the queue engine starts from the state that run ended
+        in: the proposals the change does not affect are kept and only the proposers who lost a proposal (or who are
+        new) propose again, with the queue engine. It returns the same proposer-optimal stable matching as a run from
+        scratch, and self.proposals_saved holds the number of proposals it did not have to make again (0 after a run
+        from scratch).
+
+        After every run, self.stats holds its totals (a RunStats): the engine, the number of rounds (as print_rounds
+        counts them), of proposals and of rejections, and the wall time it took.
         """
-        
-        
+
+
+        engine = kwargs.get('engine', 'rounds')
+        if engine not in ('rounds', 'queue', 'parallel'):
+            raise ValueError('Not a valid argument was passed in engine.')
+        n_jobs = kwargs.get('n_jobs')
+        if n_jobs is not None and (not isinstance(n_jobs, int) or n_jobs < 1):
+            raise ValueError('n_jobs must be a positive integer.')
+
+        if self.capacities is not None:
+            if self.compiled is None:
+                self.compile()
+            self.__require_rank_tables('Deferred_Acceptance() with capacities')
+            return self.__capacitated_deferred_acceptance(**kwargs)
+
+        self.proposals_saved = 0
+        # after a change to the problem, the run continues from where the last one ended
+        if self.__changed and self.__engine_state is not None:
+            return self.__queue_deferred_acceptance(warm_start=True, **kwargs)
+
+        if engine == 'queue':
+            if self.compiled is None:
+                self.compile()
+            self.__require_rank_tables('The queue engine')
+            return self.__queue_deferred_acceptance(**kwargs)
+
+        if engine == 'parallel' and self.compiled is None:
+            self.compile()
+        if self.compiled is not None:
+            return self.__compiled_deferred_acceptance(**kwargs)
+
+        observer = kwargs.get('observer')
+        start = started = time.perf_counter()
         P_m = self.proposers.copy()
         P_w = self.receivers.copy()
         
@@ -326,6 +1492,14 @@ class MarriageModel:
             # otherwise, we reverse the receiver-proposer mapping into a proposer-receiver dictionary
             else:
                 mu.update({p:r})
+
+        # count the proposals made so far (and report the first round to the observer, if there is one)
+        number_of_proposals = len(recent_proposals)
+        if observer is not None:
+            held = sum(1 for p in mu_r.values() if p is not None)
+            proposing = sum(1 for p in set(P_m).difference(set(mu)) if recent_proposals[p] != P_m[p][-1])
+            started = self.__observe(observer, started, itr, number_of_proposals, number_of_proposals - held,
+                                     proposing)
         
         
         # iterate while there exist rejections
@@ -401,6 +1575,12 @@ class MarriageModel:
             rejections_exist = self.__rejection_exists(P_m, mu, recent_proposals)
 
             itr +=1
+            number_of_proposals += len(new_proposals)
+            if observer is not None:
+                held_before, held = held, sum(1 for p in mu_r.values() if p is not None)
+                proposing = sum(1 for p in set(P_m).difference(set(mu)) if recent_proposals[p] != P_m[p][-1])
+                started = self.__observe(observer, started, itr, len(new_proposals),
+                                         len(new_proposals) + held_before - held, proposing)
         
         
         # denote the proposers who were left unmatched as being matched to None
@@ -413,16 +1593,253 @@ class MarriageModel:
         # print rounds if print_rounds = True, else don't
         if kwargs.get('print_rounds') is True:
             print('Success. The Gale-Shapley algorithm ran {} rounds.'.format(itr))
+
+        # every proposal is either held at the end or rejected
+        held = sum(1 for p in mu_r.values() if p is not None)
+        self.stats = RunStats('Deferred_Acceptance', 'dictionary', itr, number_of_proposals, number_of_proposals - held,
+                              time.perf_counter() - start)
         
 
         return mu
     
     
+    #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+    #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%% CHANGES TO THE PROBLEM %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+    #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+    # withdraws proposals from the saved engine state. rewinds maps proposers to the number of their proposals to
+    # keep. a withdrawn proposal takes the proposals that were rejected because of it along (and so on), so every
+    # rejection that is left was caused by a proposal that is left: Deferred Acceptance reaches the state on its own,
+    # and every proposal in it is also made by a run from scratch
+    def __withdraw_proposals(self, rewinds):
+        preferences = self.compiled.preferences[0]
+        next_choice, holder, causes = self.__engine_state
+        stack = list(rewinds.items())
+        while stack:
+            p, keep = stack.pop()
+            if keep >= next_choice[p]:
+                continue
+            # (only the last proposal of a proposer can be held)
+            r = preferences.item(p, next_choice[p] - 1)
+            if holder[r] == p:
+                holder[r] = -1
+            next_choice[p] = keep
+            stack.extend((q, position) for proposal, q, position in causes[p] if proposal >= keep)
+            causes[p] = [cause for cause in causes[p] if cause[0] < keep]
+
+
+    # returns a preference list without the given agent (a new list; the original is not modified)
+    @staticmethod
+    def __without(preferences, agent):
+        if not isinstance(preferences, list):
+            return [] if preferences == agent else preferences
+        return [choice for choice in preferences if choice != agent]
+
+
+    # replaces the preference profiles with the changed ones. the compiled preferences are rebuilt before anything is
+    # changed, so an invalid change leaves the model as it was. if there is a saved engine state, update_state
+    # carries it over to the new compiled preferences (it is called before they replace the current ones)
+    def __apply_change(self, proposers, receivers, update_state=None):
+        compiled = type(self.compiled).from_profile(proposers, receivers) if self.compiled is not None else None
+        if self.__engine_state is not None and update_state is not None:
+            update_state(*self.__engine_state)
+        self.proposers, self.receivers, self.compiled = proposers, receivers, compiled
+        self.__changed = True
+
+
+    def add_proposer(self, proposer, preferences):
+        """
+        Adds a proposer with the given preference list to the problem. The preference lists of the receivers are not
+        changed (see update_preferences()). Every proposal of the last run of Deferred Acceptance is kept.
+        """
+        if proposer in self.proposers:
+            raise ValueError('{} is already a proposer in this problem.'.format(proposer))
+
+        # (the new proposer comes last, so nobody else's integer id changes)
+        def update_state(next_choice, holder, causes):
+            next_choice.append(0)
+            causes.append([])
+
+        self.__apply_change({**self.proposers, proposer: preferences}, self.receivers, update_state)
+
+
+    def remove_proposer(self, proposer):
+        """
+        Removes a proposer from the problem, and from the preference lists of the receivers. The proposals of the last
+        run of Deferred Acceptance are kept, except for those of the proposer and those that were rejected because of
+        them.
+        """
+        if proposer not in self.proposers:
+            raise ValueError('{} is not a proposer in this problem.'.format(proposer))
+
+        def update_state(next_choice, holder, causes):
+            a = self.compiled.index[0][proposer]
+            self.__withdraw_proposals({a: 0})
+            # the proposers after the removed one move up by one
+            del next_choice[a], causes[a]
+            holder[:] = [p - (p > a) for p in holder]
+            causes[:] = [[(k, q - (q > a), j) for k, q, j in cause if q != a] for cause in causes]
+
+        self.__apply_change({k: v for k, v in self.proposers.items() if k != proposer},
+                            {k: self.__without(v, proposer) for k, v in self.receivers.items()}, update_state)
+
+
+    def add_receiver(self, receiver, preferences):
+        """
+        Adds a receiver with the given preference list to the problem. The preference lists of the proposers are not
+        changed (see update_preferences()). Every proposal of the last run of Deferred Acceptance is kept.
+        """
+        if receiver in self.receivers:
+            raise ValueError('{} is already a receiver in this problem.'.format(receiver))
+
+        def update_state(next_choice, holder, causes):
+            holder.append(-1)
+
+        self.__apply_change(self.proposers, {**self.receivers, receiver: preferences}, update_state)
+
+
+    def remove_receiver(self, receiver):
+        """
+        Removes a receiver from the problem, and from the preference lists of the proposers. Every other proposal of
+        the last run of Deferred Acceptance is kept; the proposer the receiver was holding proposes again.
+        """
+        if receiver not in self.receivers:
+            raise ValueError('{} is not a receiver in this problem.'.format(receiver))
+
+        def update_state(next_choice, holder, causes):
+            r = self.compiled.index[1][receiver]
+            # the proposals to the receiver disappear, and the positions after it on every list move up by one
+            position = self.compiled.rank_tables[0][:, r].tolist()
+            next_choice[:] = [k - (position[p] < k) for p, k in enumerate(next_choice)]
+            causes[:] = [[(k - (position[p] < k), q, j - (position[q] < j)) for k, q, j in cause
+                          if k != position[p] and j != position[q]] for p, cause in enumerate(causes)]
+            del holder[r]
+
+        self.__apply_change({k: self.__without(v, receiver) for k, v in self.proposers.items()},
+                            {k: v for k, v in self.receivers.items() if k != receiver}, update_state)
+
+
+    def update_preferences(self, agent, preferences):
+        """
+        Replaces the preference list of an agent (a proposer or a receiver) with the given one.
+        If the agent is a proposer, the proposals they made in the last run of Deferred Acceptance are kept up to the
+        first place where their old and new preference lists differ. If the agent is a receiver, the proposals they
+        received are withdrawn. In both cases, so are the proposals that were rejected because of a withdrawn one.
+        """
+        if agent in self.proposers:
+            proposers, receivers = {**self.proposers, agent: preferences}, self.receivers
+        elif agent in self.receivers:
+            proposers, receivers = self.proposers, {**self.receivers, agent: preferences}
+        else:
+            raise ValueError('{} is not present in this problem.'.format(agent))
+
+        def update_state(next_choice, holder, causes):
+            compiled = self.compiled
+            if agent in self.proposers:
+                a = compiled.index[0][agent]
+                # the proposals the proposer made are kept as long as they come in the same order on the new list
+                # (the receivers keep their order, so the new list is compiled with the same integer ids)
+                proposed = compiled.choices(0, a)[:next_choice[a]].tolist()
+                new_list = CompiledPreferences.from_profile({agent: preferences},
+                                                            dict.fromkeys(receivers, [])).choices(0, 0).tolist()
+                keep = 0
+                while keep < min(len(proposed), len(new_list)) and proposed[keep] == new_list[keep]:
+                    keep += 1
+                self.__withdraw_proposals({a: keep})
+            else:
+                position = compiled.rank_tables[0][:, compiled.index[1][agent]].tolist()
+                self.__withdraw_proposals({p: position[p] for p, k in enumerate(next_choice) if position[p] < k})
+
+        self.__apply_change(proposers, receivers, update_state)
+
+
     #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
     #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
     #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
-    
-    def is_stable(self, mu, preferences=None, married_and_singles_lists=None):
+
+    # returns the first blocking pair agent a (on the given side) is part of, or None if there is none.
+    # ranks are the current_ranks of both sides, so the candidates are the agents a prefers to their current partner
+    # and a blocking pair is formed with any of them who prefers a to their own current partner
+    def __compiled_blocking_pair(self, side, a, ranks):
+        compiled = self.compiled
+        candidates = compiled.choices(side, a)[:ranks[side][a]]
+        blocking = np.flatnonzero(compiled.rank(1 - side, candidates, a) < ranks[1 - side][candidates])
+        if blocking.size > 0:
+            return (a, int(candidates[blocking[0]]))
+        return None
+
+
+    # converts a matching written with agent labels into the partner arrays of both sides and the ranks each agent
+    # assigns to their partner, and checks that every matched agent is on their partner's preference list
+    def __compiled_partners(self, mu):
+        compiled = self.compiled
+        partners = compiled.encode_matching(mu)
+        ranks = tuple(compiled.current_ranks(side, partners[side]) for side in (0, 1))
+
+        for side in (0, 1):
+            for a in np.flatnonzero((partners[side] >= 0) & (ranks[side] >= compiled.lengths[side])).tolist():
+                raise ValueError("Error: {}, who is matched to {} in the matching, is not on {}'s preference list."
+                                 .format(compiled.labels[1 - side][partners[side][a]], compiled.labels[side][a],
+                                         compiled.labels[side][a]))
+
+        return partners, ranks
+
+
+    # converts an assignment of receivers with capacities into the partner array of the proposing side and the
+    # capacity_ranks() of the receivers, and checks that every matched agent is on their partner's preference list
+    def __capacitated_partners(self, mu):
+        compiled = self.compiled
+        partner = compiled.encode_assignment(mu, self.__capacity_array())
+
+        matched = np.flatnonzero(partner >= 0)
+        for side, agents, partners in ((0, matched, partner[matched]), (1, partner[matched], matched)):
+            for i in np.flatnonzero(compiled.rank(side, agents, partners) >= compiled.lengths[side][agents]).tolist():
+                raise ValueError("Error: {}, who is matched to {} in the matching, is not on {}'s preference list."
+                                 .format(compiled.labels[1 - side][partners[i]], compiled.labels[side][agents[i]],
+                                         compiled.labels[side][agents[i]]))
+
+        return partner, compiled.capacity_ranks(partner, self.__capacity_array())
+
+
+    # is_stable for receivers with capacities: a proposer and a receiver block an assignment if the proposer prefers the
+    # receiver to their partner and the receiver either has room left or prefers the proposer to one of their proposers
+    def __capacitated_is_stable(self, mu):
+        compiled = self.compiled
+        partner, receiver_ranks = self.__capacitated_partners(mu)
+        proposers, receivers = compiled.blocking_pairs((partner, None), receiver_ranks=receiver_ranks)
+        if len(proposers) > 0:
+            return (compiled.labels[0][proposers[0]], compiled.labels[1][receivers[0]])
+        return True
+
+
+    # is_stable on the compiled preferences. the search order follows the dictionary-based implementation:
+    # first the married couples in the order of mu, then the singles in the order of mu
+    def __compiled_is_stable(self, mu):
+        compiled = self.compiled
+        partners, ranks = self.__compiled_partners(mu)
+        # whether there is a blocking pair at all is answered with array operations, so that a stable matching is not
+        # searched agent by agent
+        if len(compiled.blocking_pairs(partners)[0]) == 0:
+            return True
+
+        # married couples are searched from the side of the proposers
+        married = [(0, compiled.index[0][k] if k in compiled.index[0] else compiled.index[0][v])
+                   for k, v in mu.items() if v is not None]
+        singles = [(0, compiled.index[0][k]) if k in compiled.index[0] else (1, compiled.index[1][k])
+                   for k, v in mu.items() if v is None]
+        # agents missing from mu are single as well
+        singles += [(side, a) for side in (0, 1) for a in np.flatnonzero(partners[side] < 0).tolist()
+                    if compiled.labels[side][a] not in mu]
+
+        for side, a in married + singles:
+            blocking_pair = self.__compiled_blocking_pair(side, a, ranks)
+            if blocking_pair is not None:
+                return (compiled.labels[side][blocking_pair[0]], compiled.labels[1 - side][blocking_pair[1]])
+
+        return True
+
+
+    def is_stable(self, mu, preferences=None, married_and_singles_lists=None, rng=np.random):
         
         """
         Evaluates whether a passed matching mu is stable with respect to the preference profile passed at class instantiation
@@ -438,14 +1855,33 @@ class MarriageModel:
         married_and_singles_lists: an optional 2-tuple where the first element is a Python dictionary of married couples 
                                    (in which the keys correspond to proposers and the values correspond to receivers) and
                                    the second element is a list of single agents
+        rng: the source of randomness used when married_and_singles_lists is passed (np.random by default, or a
+             np.random.Generator)
         
         Output: It returns either True, a blocking pair or an Error message.
         - True: if input mu has no blocking pair with respect to Preferences
         - A blocking pair if input mu has a blocking pair with respect to Preferences
         - Error message if the agents in mu are incompatible with the agents in Preferences 
           (e.g. the proposers in mu do not match the the proposers in Preferences, i.e. Preferences[0])
+
+        If the model is compiled (see compile()) and no optional input is passed, the check runs on the compiled
+        preferences.
+
+        If capacities were passed at class instance initialization, mu must map every receiver to a list of proposers
+        (as Deferred_Acceptance() returns it) and the blocking pairs are those of the many-to-one problem: a proposer
+        and a receiver who both find each other acceptable, where the proposer prefers the receiver to their partner
+        and the receiver either has room left or prefers the proposer to one of the proposers they are matched with.
+        The model is compiled if it is not compiled yet, and the first blocking pair (proposer, receiver) is returned.
         """
-        
+
+        if self.capacities is not None and preferences is None and married_and_singles_lists is None:
+            if self.compiled is None:
+                self.compile()
+            return self.__capacitated_is_stable(mu)
+
+        if self.compiled is not None and preferences is None and married_and_singles_lists is None:
+            return self.__compiled_is_stable(mu)
+
         # if this argument is not passed, extract 'married' and 'singles' from the passed mu
         if married_and_singles_lists is None:
             # and do not randomize
@@ -464,18 +1900,18 @@ class MarriageModel:
 
 
         # if mu is a matching, continue,
-        if len(set(married.values())) is len(married.values()):
+        if len(set(married.values())) == len(married.values()):
             
             # make a list of functions that will search whether couples or singles can form a blocking pair with anyone
             find_blocking_pair = [lambda: self.__blocking_pair_among_married_couples(preferences, married, 
-                                                                                     randomize=randomize), 
+                                                                                     randomize=randomize, rng=rng), 
                                   lambda: self.__blocking_pair_among_singles(preferences, singles, married, 
-                                                                             randomize=randomize)]
+                                                                             randomize=randomize, rng=rng)]
             
             # if married_and_singles_lists != None, this means this function is being used to 
             # in random_path_to_stability, so we randomize whether to check through the singles or the couples first
             if randomize:
-                np.random.shuffle(find_blocking_pair)
+                rng.shuffle(find_blocking_pair)
             
             # now, iterate over the functions,
             for func in find_blocking_pair:
@@ -500,11 +1936,419 @@ class MarriageModel:
             raise ValueError('This is not a matching. {} is matched with both {} and {} at the same time.'
                   .format(polygamous, husbands[0], husbands[1]))
 
-    
+
+    def audit_stability(self, mu, return_mask=False):
+
+        """
+        Finds every blocking pair of a matching mu with respect to the preference profile passed at class instantiation.
+        Unlike is_stable(), which stops at the first blocking pair it finds, it checks every pair of agents at once
+        with array operations on the compiled preferences (the model is compiled if it is not compiled yet).
+
+        Input:
+
+        mu:  a matching; a Python dictionary in which keys correspond to proposers and values correspond to receivers
+
+        Optional input:
+
+        return_mask: If True, the output also includes the full boolean blocking-pair mask.
+
+        Output: A Python dictionary with the following keys:
+        - 'stable': True if mu has no blocking pair (this is always the same answer as is_stable()), False otherwise
+        - 'number_of_blocking_pairs': the number of blocking pairs
+        - 'blocking_pairs': a list of every blocking pair as (proposer, receiver) tuples
+        - 'proposer_counts': a Python dictionary mapping every proposer who is part of a blocking pair to the number of
+                             blocking pairs they are part of
+        - 'receiver_counts': the same for the receivers
+        - 'mask' (only if return_mask is True): a boolean array with one row per proposer and one column per receiver
+                                                (in the order of self.compiled.labels) that is True for blocking pairs
+        Error message if the agents in mu are incompatible with the preference profile.
+
+        If capacities were passed at class instance initialization, mu is an assignment in the format
+        Deferred_Acceptance() returns and the blocking pairs are those of the many-to-one problem (see is_stable()).
+        """
+
+        if self.compiled is None:
+            self.compile()
+        compiled = self.compiled
+
+        if self.capacities is not None:
+            partner, receiver_ranks = self.__capacitated_partners(mu)
+            proposers, receivers = compiled.blocking_pairs((partner, None), receiver_ranks=receiver_ranks)
+        else:
+            partners, _ = self.__compiled_partners(mu)
+            proposers, receivers = compiled.blocking_pairs(partners)
+
+        proposer_counts = np.bincount(proposers, minlength=compiled.size[0])
+        receiver_counts = np.bincount(receivers, minlength=compiled.size[1])
+
+        audit = {'stable': len(proposers) == 0,
+                 'number_of_blocking_pairs': len(proposers),
+                 'blocking_pairs': [(compiled.labels[0][p], compiled.labels[1][r])
+                                    for p, r in zip(proposers.tolist(), receivers.tolist())],
+                 'proposer_counts': {compiled.labels[0][p]: int(proposer_counts[p])
+                                     for p in np.flatnonzero(proposer_counts).tolist()},
+                 'receiver_counts': {compiled.labels[1][r]: int(receiver_counts[r])
+                                     for r in np.flatnonzero(receiver_counts).tolist()}}
+
+        if return_mask:
+            mask = np.zeros(compiled.size, dtype=bool)
+            mask[proposers, receivers] = True
+            audit['mask'] = mask
+
+        return audit
+
+
+    def estimate_stability(self, mu, method='pairs', confidence=0.95, tolerance=0.01, max_samples=10**6,
+                           time_budget=None, seed=None, batch_size=4096):
+
+        """
+        Estimates how far a matching mu is from being stable by checking a random sample of it, for markets in which
+        even audit_stability() takes too long to run as often as needed. The partners and ranks are looked up as in
+        is_stable(); with a Matching on the model's compiled preferences no labels are looked up at all.
+
+        Input:
+
+        mu: a matching, as for is_stable()
+
+        Optional input:
+
+        method:      Either 'pairs' (default) or 'agents'.
+                     'pairs' draws (proposer, receiver) pairs uniformly at random and estimates the share of all pairs
+                     that block mu.
+                     'agents' draws proposers uniformly at random, checks every receiver each of them prefers to
+                     their partner and estimates the share of proposers who are part of a blocking pair.
+        confidence:  The confidence level of the interval (default 0.95).
+        tolerance:   The sampling stops as soon as the half-width of the interval is at most tolerance (default 0.01).
+        max_samples: The sampling stops after this many samples (default 10**6).
+        time_budget: If passed, the sampling stops after this many seconds.
+        seed:        Seeds the sampling (anything np.random.default_rng accepts).
+        batch_size:  The number of samples drawn at a time; the stopping rules are checked after every batch.
+
+        Output: A Python dictionary with the following keys:
+        - 'method': the method
+        - 'samples': the number of pairs (or proposers) drawn
+        - 'estimate': the estimated share of the pairs that block mu (or of the proposers who are part of a
+                      blocking pair)
+        - 'interval': the Wilson score interval of the share at the given confidence level, as (low, high)
+        - 'converged': True if the sampling stopped because the interval was tight enough
+        - 'number_of_blocking_pairs': the estimated number of blocking pairs
+        - 'blocking_pair': the first blocking pair (proposer, receiver) found, or None if none was found (in which
+                           case mu may still be unstable)
+        - 'seconds': the wall time it took
+
+        If capacities were passed at class instance initialization, mu is an assignment in the format
+        Deferred_Acceptance() returns and the blocking pairs are those of the many-to-one problem (see is_stable()).
+        The model is compiled if it is not compiled yet.
+        """
+        if method not in ('pairs', 'agents'):
+            raise ValueError('Not a valid argument was passed in method.')
+        if not 0 < confidence < 1:
+            raise ValueError('confidence must be between 0 and 1.')
+
+        start = time.perf_counter()
+        if self.compiled is None:
+            self.compile()
+        compiled = self.compiled
+        if self.capacities is not None:
+            partner, receiver_ranks = self.__capacitated_partners(mu)
+            ranks = (compiled.current_ranks(0, partner), receiver_ranks)
+        else:
+            _, ranks = self.__compiled_partners(mu)
+
+        rng = np.random.default_rng(seed)
+        z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+        samples = hits = number_of_pairs = 0
+        first = None
+        # in the agents method, a batch checks at most about 2**22 entries of the preference lists
+        if method == 'agents':
+            batch_size = max(1, min(batch_size, 2**22 // max(1, int(compiled.lengths[0].max(initial=0)))))
+
+        while samples < max_samples:
+            size = min(batch_size, max_samples - samples)
+            if method == 'pairs':
+                proposers = rng.integers(compiled.size[0], size=size)
+                receivers = rng.integers(compiled.size[1], size=size)
+                # a pair blocks mu if both prefer each other to their partners (see CompiledPreferences.blocking_pairs)
+                blocking = ((compiled.rank(0, proposers, receivers) < ranks[0][proposers])
+                            & (compiled.rank(1, receivers, proposers) < ranks[1][receivers]))
+                hits += int(np.count_nonzero(blocking))
+            else:
+                sampled = rng.integers(compiled.size[0], size=size)
+                # the receivers each sampled proposer prefers to their partner come before it on their list
+                prefix = ranks[0][sampled]
+                row = np.repeat(np.arange(size), prefix)
+                proposers = sampled[row]
+                positions = np.arange(len(row)) - np.repeat(np.cumsum(prefix) - prefix, prefix)
+                receivers = compiled.choice(0, proposers, positions)
+                blocking = compiled.rank(1, receivers, proposers) < ranks[1][receivers]
+                hits += int(np.count_nonzero(np.bincount(row[blocking], minlength=size)))
+                number_of_pairs += int(np.count_nonzero(blocking))
+
+            if first is None and np.any(blocking):
+                i = int(np.argmax(blocking))
+                first = (compiled.labels[0][proposers[i]], compiled.labels[1][receivers[i]])
+            samples += size
+
+            # the Wilson score interval of the share of hits
+            share = hits / samples
+            center = (share + z * z / (2 * samples)) / (1 + z * z / samples)
+            half = z * np.sqrt(share * (1 - share) / samples + z * z / (4 * samples * samples)) / (1 + z * z / samples)
+            converged = half <= tolerance
+            if converged or (time_budget is not None and time.perf_counter() - start >= time_budget):
+                break
+
+        if samples == 0:
+            center, half, converged = 0.5, 0.5, False
+        if method == 'pairs':
+            estimate = hits / samples * compiled.size[0] * compiled.size[1] if samples else 0.0
+        else:
+            estimate = number_of_pairs / samples * compiled.size[0] if samples else 0.0
+
+        return {'method': method,
+                'samples': samples,
+                'estimate': hits / samples if samples else 0.0,
+                'interval': (max(0.0, float(center - half)), min(1.0, float(center + half))),
+                'converged': bool(converged),
+                'number_of_blocking_pairs': estimate,
+                'blocking_pair': first,
+                'seconds': time.perf_counter() - start}
+
+
     #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
     #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
     #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
-    
+
+    # one random path to stability on the compiled preferences
+    # the partners of both sides are kept in two arrays and the set of blocking pairs is kept up to date as the path
+    # goes on: matching a blocking pair only changes the situation of the pair and of their former partners, so only
+    # the pairs these (at most four) agents can be part of are checked again. the next blocking pair to be matched is
+    # drawn uniformly from the set. a pair is identified by its entry among the entries of the proposers' preference
+    # lists, so the set is an array of entries together with the position of each entry in it (-1 if absent)
+    def __compiled_random_path(self, rng=np.random, **kwargs):
+        compiled = self.compiled
+        observer = kwargs.get('observer')
+        started = time.perf_counter()
+        owners, _, targets = compiled.entries(0)
+        offsets = np.concatenate(([0], np.cumsum(compiled.lengths[0], dtype=np.int64)))
+
+        # everyone starts out as single, so every mutually acceptable pair is a blocking pair
+        partners = (np.full(compiled.size[0], -1, dtype=np.int64), np.full(compiled.size[1], -1, dtype=np.int64))
+        ranks = (compiled.lengths[0].astype(np.int64), compiled.lengths[1].astype(np.int64))
+        blocking = np.flatnonzero(compiled.rank(1, targets, owners) < compiled.lengths[1][targets])
+        pairs = np.zeros(len(owners), dtype=np.int64)
+        pairs[:len(blocking)] = blocking
+        position = np.full(len(owners), -1, dtype=np.int64)
+        position[blocking] = np.arange(len(blocking))
+        number_of_pairs = len(blocking)
+
+        # returns the entries of the pairs agent a (on the given side) can be part of and which of them are blocking
+        def blocking_entries(side, a):
+            choices = compiled.choices(side, a)
+            if side == 0:
+                rank = np.arange(len(choices))
+                return offsets[a] + rank, (rank < ranks[0][a]) & (compiled.rank(1, choices, a) < ranks[1][choices])
+            # (only the proposers who have a on their list can form a pair with a)
+            rank = compiled.rank(0, choices, a)
+            listed = np.flatnonzero(rank < compiled.lengths[0][choices])
+            choices, rank = choices[listed], rank[listed]
+            return offsets[choices] + rank, (listed < ranks[1][a]) & (rank < ranks[0][choices])
+
+        rounds, breakups = 1, 0
+        while number_of_pairs > 0:
+
+            rounds += 1
+            # draw a blocking pair uniformly at random
+            entry = pairs[int(rng.random() * number_of_pairs)]
+            p, r = int(owners[entry]), int(targets[entry])
+
+            # the pair and their partners (if any) are the only agents whose situation changes
+            affected = [(0, p), (1, r)]
+            if partners[0][p] >= 0:
+                affected.append((1, int(partners[0][p])))
+            if partners[1][r] >= 0:
+                affected.append((0, int(partners[1][r])))
+            before = [blocking_entries(side, a) for side, a in affected]
+
+            # break up both members of the blocking pair from their partners,
+            for side, a in affected[2:]:
+                partners[side][a] = -1
+                ranks[side][a] = compiled.lengths[side][a]
+            # and match the blocking pair with one another
+            partners[0][p], partners[1][r] = r, p
+            ranks[0][p], ranks[1][r] = compiled.rank(0, p, r), compiled.rank(1, r, p)
+
+            # update the set of blocking pairs where the status of a pair has changed
+            for (side, a), (entries, was_blocking) in zip(affected, before):
+                is_blocking = blocking_entries(side, a)[1]
+                for entry in entries[was_blocking & ~is_blocking].tolist():
+                    if position[entry] >= 0:
+                        number_of_pairs -= 1
+                        last = pairs[number_of_pairs]
+                        pairs[position[entry]] = last
+                        position[last] = position[entry]
+                        position[entry] = -1
+                for entry in entries[is_blocking & ~was_blocking].tolist():
+                    if position[entry] < 0:
+                        pairs[number_of_pairs] = entry
+                        position[entry] = number_of_pairs
+                        number_of_pairs += 1
+
+            # (the step is numbered as the round of the dictionary-based implementation it is made in)
+            breakups += len(affected) - 2
+            if observer is not None:
+                started = self.__observe(observer, started, rounds - 1, 1, len(affected) - 2,
+                                         int(np.count_nonzero(partners[0] < 0)))
+
+        # if there is no blocking pair left, the matching is stable
+        if kwargs.get('print_rounds') is True:
+            print('The algorithm ran {} rounds to reach the following stable matching:'.format(rounds))
+            print(compiled.decode_matching(partners[0]))
+        return partners[0].astype(np.int32), rounds, breakups
+
+
+    # one random path to stability; rng is the source of randomness (either np.random or a np.random.Generator).
+    # it returns the stable matching it reaches (as an int32 array of the partners of the proposers, -1 if unmatched,
+    # over the agents of __lottery_labels()), the number of rounds it took and the number of partners the agents who
+    # were matched along the way left
+    def __random_path(self, rng=np.random, **kwargs):
+
+        if self.compiled is not None:
+            return self.__compiled_random_path(rng, **kwargs)
+
+        observer = kwargs.get('observer')
+        started = time.perf_counter()
+        breakups = 0
+
+        # will need to randomize the person doing the 'proposing'
+        preferences = [self.proposers, self.receivers] # will use the preference lists passed at initialization
+
+        # first let each person start out as single
+        # the matches made (as well as those who remain unmatched) in each round of the while loop 
+        # as well as the final matching will be saved in mu
+        mu = {person: None for person in list(preferences[0])+list(preferences[1])}
+        
+        rounds = 0 # this counts the number of iterations it takes to reach a stable matching 
+                   # (i.e. the number of iterations it takes to exit the while-loop below)
+        
+        while True:
+            
+            rounds += 1
+            # randomly choose the side whose preferences will be the primary point of reference in each round,
+            rng.shuffle(preferences)
+            # copy the married couples so far in mu into married
+            married = {k:v for k,v in mu.items() if v is not None}
+            # copy the singles so far in mu into singles
+            singles = [k for k,v in mu.items() if v is None]
+            # and check if the keys of the married couples match the keys of preferences[0]
+            # (since is_stable loops through preferences[0] for married couples, 
+            # it is essential that married is a subset of preferences[0]
+            if married != {} and set(married).issubset(set(preferences[0])) is False:
+                # if they do not match, reverse keys and values 
+                # so that married is a subset of preferences[0]
+                married = {v:k for k,v in married.items()}
+                mu = married.copy()
+                # do not have to reverse single
+                mu.update({k:None for k in singles})
+            
+            # check if there is blocking pair in mu. is_stable can return a blocking pair or True
+            # (note that is_stable will never return None since at each round, mu that is passed 
+            # into it is guaranteed to be a matching)
+            blocking_pair = self.is_stable(mu, preferences, (married, singles), rng)
+            
+            
+            # if blocking_pair returns True, it means mu is stable, so we exit the loop and mu is the final matching
+            if blocking_pair is True:
+                # if print_rounds is True then print the number of rounds it took to reach a stable matching
+                if kwargs.get('print_rounds') is True:
+                    print('The algorithm ran {} rounds to reach the following stable matching:'.format(rounds))
+                    print(mu)
+                break
+            # if it returns a blocking pair
+            else:
+                # blocking_pair is a tuple and if its first element is not someone whose preferences  
+                # are represented in preferences[0], then it means that it was reversed during 
+                # randomization in is_stable, so we reverse it back
+                # (blocking_pair[0] must also be mu, but that follows if it is in preferences[0], so the
+                # reversal below is essential as it normalizes the way we keep track of each match made so far)
+                if blocking_pair[0] not in preferences[0]:
+                    blocking_pair = (blocking_pair[1], blocking_pair[0])
+                
+                # if blocking_pair[0] had a partner in mu,
+                left = 0
+                if mu[blocking_pair[0]] is not None:
+                    # break them up and make blocking_pair[0]'s partner single
+                    mu.update({mu[blocking_pair[0]]: None})
+                    left += 1
+                
+                # check if blocking_pair[1] had a partner in mu,
+                jilted_proposer = next((p for p, r in mu.items() if r == blocking_pair[1]), None)
+                # and if there was a partner under mu,
+                if jilted_proposer is not None:
+                    # break them up and make blocking_pair[1]'s partner single
+                    mu.update({jilted_proposer: None})
+                    left += 1
+                # if blocking_pair[1] did not have a partner, i.e. single, delete blocking_pair[1] from mu
+                # (note that singles are matched to None in mu)
+                else:
+                    mu.pop(blocking_pair[1])
+                
+                # finally match the blocking_pair with one another
+                mu.update({blocking_pair[0]:blocking_pair[1]})
+
+                breakups += left
+                if observer is not None:
+                    matched = {agent for pair in mu.items() if pair[1] is not None for agent in pair}
+                    started = self.__observe(observer, started, rounds, 1, left,
+                                             sum(1 for p in self.proposers if p not in matched))
+        
+        # whenever the while loop breaks, it means that mu that was continuously updated in it is a stable matching
+        # (its keys may be proposers or receivers, depending on the side that was shuffled first in the last round)
+        proposers, receivers = self.__lottery_labels()
+        index = {receiver: j for j, receiver in enumerate(receivers)}
+        matches = dict((k, v) if k in self.proposers else (v, k) for k, v in mu.items() if v is not None)
+        partner = np.array([index.get(matches.get(proposer), -1) for proposer in proposers], dtype=np.int32)
+        return partner, rounds, breakups
+
+
+    # the labels of the agents the random paths encode their matchings over
+    def __lottery_labels(self):
+        if self.compiled is not None:
+            return self.compiled.labels
+        return list(self.proposers), list(self.receivers)
+
+
+    # draws the random paths of random_path_to_stability() one after the other (in the order of their seeds) and
+    # yields what each of them returns. the seeds are spawned as the paths are drawn, and the worker processes are
+    # given the paths in batches, so that the paths that are not drawn (if the caller stops early) cost nothing
+    def __random_paths(self, number_of_matchings, seed, n_jobs, kwargs):
+
+        # without a seed or workers, the paths use the global state of np.random (as they always have)
+        if seed is None and n_jobs == 1:
+            for _ in range(number_of_matchings):
+                yield self.__random_path(np.random, **kwargs)
+            return
+
+        # otherwise, every path gets its own random number generator seeded by its own child of seed, so that
+        # each path only depends on its own generator and the outcome does not depend on the number of workers
+        # (spawning the children one at a time gives the same children as spawning them all at once)
+        sequence = np.random.SeedSequence(seed)
+        seeds = (sequence.spawn(1)[0] for _ in range(number_of_matchings))
+        if n_jobs == 1:
+            for s in seeds:
+                yield self.__random_path(np.random.default_rng(s), **kwargs)
+            return
+
+        chunksize = max(1, min(number_of_matchings // (n_jobs * 4), 256))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs, initializer=_set_worker_model,
+                                                    initargs=(self,)) as executor:
+            while True:
+                batch = list(itertools.islice(seeds, chunksize * n_jobs * 4))
+                if not batch:
+                    return
+                # executor.map returns the paths in the order of their seeds
+                yield from executor.map(_random_path, batch, itertools.repeat(kwargs), chunksize=chunksize)
+
+
     def random_path_to_stability(self, number_of_matchings=1, **kwargs):
         
         """
@@ -521,111 +2365,654 @@ class MarriageModel:
         Optional input:
         
         print_rounds: If True, prints the number of rounds it took to reach a stable matching in each iteration.
-        
+        seed: Seeds the random paths (anything np.random.SeedSequence accepts). Every path gets its own
+              np.random.Generator, so the lottery is reproducible for a given seed whatever n_jobs is.
+              If neither seed nor n_jobs is passed, the global state of np.random is used.
+        n_jobs: The number of worker processes the paths are spread over. Default is 1 (no worker processes).
+        patience: A positive integer. If passed, the lottery stops early once this many paths in a row have reached
+                  matchings that earlier paths had already reached (so number_of_matchings is the most paths drawn).
+        observer: A callable that receives a RoundEvent after every step of every path, in which a blocking pair is
+                  matched (see Deferred_Acceptance()). It cannot be passed together with n_jobs.
+
         Output:
-        
-        Returns a lottery of stable matchings.
+
+        Returns a lottery of stable matchings: the distinct stable matchings reached (self.support, in the order in
+        which they were first reached) and the number of paths that reached each of them (self.frequencies). Only
+        the distinct matchings are kept as the paths are drawn, so the memory a lottery takes does not grow with
+        number_of_matchings.
+
+        If the model is compiled (see compile()), the random paths run on the compiled preferences.
+        After every run, self.stats holds its totals (a RunStats) summed over the paths: the number of rounds, of
+        blocking pairs matched (as proposals) and of partners left by the agents of those pairs (as rejections).
         """
-        
-        # will need to randomize the person doing the 'proposing'
-        preferences = [self.proposers, self.receivers] # will use the preference lists passed at initialization
-        output = [] # this list will collect all matchings
-        
-        # we need to find number_of_matchings number of matchings, 
-        for i in range(number_of_matchings):
-            
-            # first let each person start out as single
-            # the matches made (as well as those who remain unmatched) in each round of the while loop 
-            # as well as the final matching will be saved in mu
-            mu = {person: None for person in list(preferences[0])+list(preferences[1])}
-            
-            rounds = 0 # this counts the number of iterations it takes to reach a stable matching 
-                       # (i.e. the number of iterations it takes to exit the while-loop below)
-            
-            while True:
-                
-                rounds += 1
-                # randomly choose the side whose preferences will be the primary point of reference in each round,
-                np.random.shuffle(preferences)
-                # copy the married couples so far in mu into married
-                married = {k:v for k,v in mu.items() if v is not None}
-                # copy the singles so far in mu into singles
-                singles = [k for k,v in mu.items() if v is None]
-                # and check if the keys of the married couples match the keys of preferences[0]
-                # (since is_stable loops through preferences[0] for married couples, 
-                # it is essential that married is a subset of preferences[0]
-                if married != {} and set(married).issubset(set(preferences[0])) is False:
-                    # if they do not match, reverse keys and values 
-                    # so that married is a subset of preferences[0]
-                    married = {v:k for k,v in married.items()}
-                    mu = married.copy()
-                    # do not have to reverse single
-                    mu.update({k:None for k in singles})
-                
-                # check if there is blocking pair in mu. is_stable can return a blocking pair or True
-                # (note that is_stable will never return None since at each round, mu that is passed 
-                # into it is guaranteed to be a matching)
-                blocking_pair = self.is_stable(mu, preferences, (married, singles))
-                
-                
-                # if blocking_pair returns True, it means mu is stable, so we exit the loop and mu is the final matching
-                if blocking_pair is True:
-                    # if print_rounds is True then print the number of rounds it took to reach a stable matching
-                    if kwargs.get('print_rounds') is True:
-                        print('The algorithm ran {} rounds to reach the following stable matching:'.format(rounds))
-                        print(mu)
+
+        if self.capacities is not None:
+            raise ValueError('random_path_to_stability() is only available for one-to-one problems.')
+
+        seed = kwargs.pop('seed', None)
+        n_jobs = kwargs.pop('n_jobs', 1)
+        patience = kwargs.pop('patience', None)
+        if kwargs.get('observer') is not None and n_jobs != 1:
+            raise ValueError('An observer cannot be passed together with n_jobs; the paths of worker processes '
+                             'cannot report to it.')
+        if patience is not None and (not isinstance(patience, int) or patience < 1):
+            raise ValueError('patience must be a positive integer.')
+        start = time.perf_counter()
+
+        # every path returns the matching it reaches as the array of the partners of the proposers, which is counted
+        # under its bytes as soon as it comes in, so that only the distinct matchings are kept
+        counts = collections.Counter()
+        rounds = breakups = draws = since_new = 0
+        for partner, path_rounds, path_breakups in self.__random_paths(number_of_matchings, seed, n_jobs, kwargs):
+            key = partner.tobytes()
+            since_new = since_new + 1 if key in counts else 0
+            counts[key] += 1
+            rounds, breakups, draws = rounds + path_rounds, breakups + path_breakups, draws + 1
+            # stop early if the last patience paths all reached matchings that were reached before
+            if patience is not None and since_new >= patience:
+                break
+
+        self.stats = RunStats('random_path_to_stability', 'dictionary' if self.compiled is None else 'compiled',
+                              rounds, rounds - draws, breakups, time.perf_counter() - start)
+
+        # every distinct matching is turned into a dictionary that lists the matched pairs in the alphabetical order
+        # of the proposers, followed by the unmatched agents (see sort_matching())
+        proposers, receivers = self.__lottery_labels()
+        def decode(key):
+            partner = np.frombuffer(key, dtype=np.int32)
+            mu = {proposers[p]: (receivers[r] if r >= 0 else None) for p, r in enumerate(partner.tolist())}
+            matched = set(partner.tolist())
+            mu.update({receiver: None for j, receiver in enumerate(receivers) if j not in matched})
+            return dict(self.sort_matching(mu, proposers))
+
+        # the matchings are listed in the order in which they were first reached
+        self.support = [decode(key) for key in counts]
+        self.frequencies = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+
+        # if there is only one matching, then return it
+        if number_of_matchings == 1:
+            return self.support[0]
+        # but if there are multiple, return the distinct matchings and the number of times each of them was reached
+        else:
+            return self.support, self.frequencies
+
+
+    #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+    #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%% ROTATIONS %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+    #%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+    # returns the partner arrays of the proposers in the proposer-optimal and in the receiver-optimal stable matchings
+    # (the latter is found by letting the receivers propose on the swapped compiled preferences)
+    def __optimal_partners(self):
+        if self.capacities is not None:
+            raise ValueError('Rotations are only available for one-to-one problems.')
+        if self.compiled is None:
+            self.compile()
+        self.__require_rank_tables('Rotations')
+        compiled = self.compiled
+
+        reverse = MarriageModel(self.receivers, self.proposers)
+        reverse.compiled = compiled.swapped()
+        return tuple(compiled.encode_matching(model.Deferred_Acceptance(engine='queue'))[0]
+                     for model in (self, reverse))
+
+
+    # finds every rotation of the problem by walking from the proposer-optimal towards the receiver-optimal stable
+    # matching (Gusfield and Irving (1989), Section 3.2). next(p) is the first receiver after p's partner on p's list
+    # who prefers p to their own partner, and a rotation is a cycle of the proposers p -> partner of next(p);
+    # eliminating it matches every proposer in it with next(p). the proposers on the walk are kept on a stack, so
+    # that every pointer only moves forward and the rotations are found in an order in which they can be eliminated.
+    # the precedence relation between the rotations is built along the way (Section 3.3): a rotation comes after
+    # (i)  the rotation that matched one of its proposers to the partner they leave in it, and
+    # (ii) the rotation that moved a receiver whom one of its proposers skips from below to above that proposer on
+    #      the receiver's list.
+    # it returns the partners of the proposers in the proposer-optimal stable matching, the rotations as pairs of
+    # arrays (the proposers and the partners they leave, so that proposers[i] is matched to partners[i + 1]) and
+    # the immediate predecessors of every rotation
+    def __rotations(self):
+        first, last = self.__optimal_partners()
+        compiled = self.compiled
+        preferences, proposer_ranks, receiver_ranks = (compiled.preferences[0], compiled.rank_tables[0],
+                                                       compiled.rank_tables[1])
+
+        partner = first.tolist()
+        husband = [-1] * compiled.size[1]
+        for p, r in enumerate(partner):
+            if r >= 0:
+                husband[r] = p
+        pointer = [proposer_ranks.item(p, r) + 1 if r >= 0 else 0 for p, r in enumerate(partner)]
+
+        # returns next(p) and moves p's pointer to it
+        def next_receiver(p):
+            k = pointer[p]
+            r = preferences.item(p, k)
+            while receiver_ranks.item(r, p) >= receiver_ranks.item(r, husband[r]):
+                k += 1
+                r = preferences.item(p, k)
+            pointer[p] = k
+            return r
+
+        rotations, predecessors = [], []
+        moved_by = [-1] * compiled.size[0]    # the last rotation each proposer was moved by
+        crossed_by = {}                       # the rotation that moved receiver r from below p to above p
+        stack, on_stack = [], [False] * compiled.size[0]
+
+        for start in range(compiled.size[0]):
+            while stack or partner[start] != last[start]:
+                if not stack:
+                    stack.append(start)
+                    on_stack[start] = True
+
+                husband_of_next = husband[next_receiver(stack[-1])]
+                if not on_stack[husband_of_next]:
+                    stack.append(husband_of_next)
+                    on_stack[husband_of_next] = True
+                    continue
+
+                # the proposers from husband_of_next to the top of the stack form a rotation
+                at = stack.index(husband_of_next)
+                proposers, stack[at:] = stack[at:], []
+                partners = [partner[p] for p in proposers]
+                rotation = len(rotations)
+                before = set()
+                for i, p in enumerate(proposers):
+                    on_stack[p] = False
+                    old, new = partners[i], partners[(i + 1) % len(proposers)]
+                    if moved_by[p] >= 0:
+                        before.add(moved_by[p])
+                    moved_by[p] = rotation
+                    for k in range(proposer_ranks.item(p, old) + 1, proposer_ranks.item(p, new)):
+                        if (p, preferences.item(p, k)) in crossed_by:
+                            before.add(crossed_by[p, preferences.item(p, k)])
+                for i, r in enumerate(partners):
+                    new, old = proposers[i - 1], proposers[i]
+                    for k in range(receiver_ranks.item(r, new) + 1, receiver_ranks.item(r, old)):
+                        crossed_by[compiled.preferences[1].item(r, k), r] = rotation
+
+                # eliminate the rotation
+                for i, p in enumerate(proposers):
+                    partner[p] = partners[(i + 1) % len(proposers)]
+                    husband[partner[p]] = p
+                    pointer[p] += 1
+                rotations.append((np.array(proposers, dtype=np.int64), np.array(partners, dtype=np.int64)))
+                predecessors.append(sorted(before))
+
+        return first, rotations, predecessors
+
+
+    def all_stable_matchings(self):
+        """
+        A generator that yields every stable matching of the preference profile passed at class instance
+        initialization, each one exactly once. It finds the rotations that lead from the proposer-optimal to the
+        receiver-optimal stable matching (one run of Deferred Acceptance from each side and a single walk over the
+        preference lists), and every stable matching corresponds to a set of rotations that is closed under the
+        precedence relation between them. These sets are listed by a depth-first search over the rotations, so the
+        time between two stable matchings is polynomial and only the current matching is held in memory.
+
+        The model is compiled (see compile()) if it is not compiled yet.
+
+        Yields dictionaries in the format Deferred_Acceptance() returns. The first one is the proposer-optimal
+        stable matching.
+        """
+        first, rotations, predecessors = self.__rotations()
+        partner = first.copy()
+        eliminated = [False] * len(rotations)
+
+        def eliminate(rotation, undo=False):
+            proposers, partners = rotations[rotation]
+            partner[proposers] = partners if undo else np.roll(partners, -1)
+            eliminated[rotation] = not undo
+
+        # each decision on the path is a rotation and whether it is eliminated; the rotations are decided in the
+        # order they were found, which puts every rotation after its predecessors
+        path, rotation = [], 0
+        while True:
+            if rotation < len(rotations):
+                path.append((rotation, False))
+                rotation += 1
+                continue
+
+            yield self.compiled.decode_matching(partner)
+
+            # go back to the last rotation that was left out although it could have been eliminated
+            while path:
+                rotation, was_eliminated = path.pop()
+                if was_eliminated:
+                    eliminate(rotation, undo=True)
+                elif all(eliminated[before] for before in predecessors[rotation]):
+                    eliminate(rotation)
+                    path.append((rotation, True))
+                    rotation += 1
                     break
-                # if it returns a blocking pair
+            else:
+                return
+
+
+    # returns a set of rotations that is closed under the precedence relation and has the smallest total weight
+    # (Picard (1976)): every rotation of negative weight is joined to a source and every rotation of positive weight to
+    # a sink, a rotation is joined to each of its predecessors by an edge that cannot be cut, and the source side of a
+    # minimum cut is the set. the maximum flow is found with Dinic's algorithm
+    @staticmethod
+    def __minimum_weight_closure(weights, predecessors):
+        source, sink = len(weights), len(weights) + 1
+        infinity = sum(abs(weight) for weight in weights) + 1
+
+        # the edges are stored in pairs, so that edge e ^ 1 is the reverse of edge e
+        adjacency, heads, capacities = [[] for _ in range(len(weights) + 2)], [], []
+        def add_edge(tail, head, capacity):
+            adjacency[tail].append(len(heads))
+            heads.append(head)
+            capacities.append(capacity)
+            adjacency[head].append(len(heads))
+            heads.append(tail)
+            capacities.append(0)
+
+        for rotation, weight in enumerate(weights):
+            if weight < 0:
+                add_edge(source, rotation, -weight)
+            elif weight > 0:
+                add_edge(rotation, sink, weight)
+            for before in predecessors[rotation]:
+                add_edge(rotation, before, infinity)
+
+        # returns the distance of every node from the source along edges with capacity left (-1 if unreachable)
+        def levels():
+            level = [-1] * len(adjacency)
+            level[source] = 0
+            queue = [source]
+            for node in queue:
+                for edge in adjacency[node]:
+                    if capacities[edge] > 0 and level[heads[edge]] < 0:
+                        level[heads[edge]] = level[node] + 1
+                        queue.append(heads[edge])
+            return level
+
+        level = levels()
+        while level[sink] >= 0:
+            # push flow along shortest paths until there is none left (a blocking flow)
+            following, path, node = [0] * len(adjacency), [], source
+            while True:
+                if node == sink:
+                    flow = min(capacities[edge] for edge in path)
+                    for edge in path:
+                        capacities[edge] -= flow
+                        capacities[edge ^ 1] += flow
+                    path, node = [], source
+                    continue
+                edges = adjacency[node]
+                while following[node] < len(edges) and (capacities[edges[following[node]]] == 0 or
+                                                        level[heads[edges[following[node]]]] != level[node] + 1):
+                    following[node] += 1
+                if following[node] < len(edges):
+                    path.append(edges[following[node]])
+                    node = heads[path[-1]]
+                # a dead end is never visited again in this phase
+                elif path:
+                    node = heads[path.pop() ^ 1]
+                    following[node] += 1
                 else:
-                    # blocking_pair is a tuple and if its first element is not someone whose preferences  
-                    # are represented in preferences[0], then it means that it was reversed during 
-                    # randomization in is_stable, so we reverse it back
-                    # (blocking_pair[0] must also be mu, but that follows if it is in preferences[0], so the
-                    # reversal below is essential as it normalizes the way we keep track of each match made so far)
-                    if blocking_pair[0] not in preferences[0]:
-                        blocking_pair = (blocking_pair[1], blocking_pair[0])
-                    
-                    # if blocking_pair[0] had a partner in mu,
-                    if mu[blocking_pair[0]] is not None:
-                        # break them up and make blocking_pair[0]'s partner single
-                        mu.update({mu[blocking_pair[0]]: None})
-                    
-                    # check if blocking_pair[1] had a partner in mu,
-                    jilted_proposer = next((p for p, r in mu.items() if r is blocking_pair[1]), None)
-                    # and if there was a partner under mu,
-                    if jilted_proposer is not None:
-                        # break them up and make blocking_pair[1]'s partner single
-                        mu.update({jilted_proposer: None})
-                    # if blocking_pair[1] did not have a partner, i.e. single, delete blocking_pair[1] from mu
-                    # (note that singles are matched to None in mu)
-                    else:
-                        mu.pop(blocking_pair[1])
-                    
-                    # finally match the blocking_pair with one another
-                    mu.update({blocking_pair[0]:blocking_pair[1]})
-            
-            # whenever the while loop breaks, it means that mu that was continuously updated in it is a stable matching,
-            # so append it to output
-            output.append(mu)   # output is a list of dictionaries
-        
-        
-        # the proposers will serve as keys when sorting the matches
-        keys = list(self.proposers)
-        # and sort every matching in output in the alphabetical order of the saved keys
-        # output is now a list of list of tuples (it was a list of dictionaries before)
-        # note that there is no proposer-receiver here since the matches are made randomly; 
-        # hence there is no need for a dictionary
-        output = [self.sort_matching(mu, keys) for mu in output]
-        # find the list of unique matchings (i.e. a list of tuples)
-        # and count the number of times each unique matching is in output
-        self.support, self.frequencies = np.unique(output, axis=0, return_counts=True)
-        
-        self.support = [{match[0]:match[1] for match in matching} for matching in self.support]
-        
-        
-        # if there is only one matching, then return a list of tuples (i.e. a matching)
-        if number_of_matchings is 1:
-            return {match[0]:match[1] for match in output[0]}
-        # but if there are multiple, return a list of list of tuples
+                    break
+            level = levels()
+
+        return [rotation for rotation in range(len(weights)) if level[rotation] >= 0]
+
+
+    # returns the rotations that lead from the proposer-optimal stable matching to a minimum regret stable matching
+    # (Gusfield (1987), Section 3). the proposers only get worse and the receivers only get better as rotations are
+    # eliminated, so as long as the largest regret belongs to a receiver, any better matching has to eliminate the
+    # rotation that moves that receiver (and its predecessors); once it belongs to a proposer, no later matching can
+    # do better. the receivers are kept in buckets by the rank of their partner, so the largest regret is found in
+    # amortized constant time
+    def __minimum_regret_rotations(self, first, rotations, predecessors):
+        compiled = self.compiled
+        proposer_ranks, receiver_ranks = compiled.rank_tables
+
+        partner = first.tolist()
+        husband = [-1] * compiled.size[1]
+        for p, r in enumerate(partner):
+            if r >= 0:
+                husband[r] = p
+        # the rotation in which a proposer leaves a partner
+        leaves = {(p, r): rotation for rotation, (proposers, partners) in enumerate(rotations)
+                  for p, r in zip(proposers.tolist(), partners.tolist())}
+
+        proposer_regret = max((proposer_ranks.item(p, r) for p, r in enumerate(partner) if r >= 0), default=-1)
+        buckets = [set() for _ in range(compiled.preferences[1].shape[1])]
+        for r, p in enumerate(husband):
+            if p >= 0:
+                buckets[receiver_ranks.item(r, p)].add(r)
+        receiver_regret = max((rank for rank, bucket in enumerate(buckets) if bucket), default=-1)
+
+        eliminated = [False] * len(rotations)
+        chosen = []
+        best_regret, best_length = max(proposer_regret, receiver_regret), 0
+        while receiver_regret > proposer_regret:
+            r = next(iter(buckets[receiver_regret]))
+            if (husband[r], r) not in leaves:
+                break
+
+            # find the rotation that moves r and the predecessors it needs that have not been eliminated yet,
+            needed, stack = set(), [leaves[husband[r], r]]
+            while stack:
+                rotation = stack.pop()
+                if not eliminated[rotation] and rotation not in needed:
+                    needed.add(rotation)
+                    stack.extend(predecessors[rotation])
+            # and eliminate them in the order they were found
+            for rotation in sorted(needed):
+                proposers, partners = rotations[rotation]
+                for p, new in zip(proposers.tolist(), np.roll(partners, -1).tolist()):
+                    buckets[receiver_ranks.item(new, husband[new])].discard(new)
+                    buckets[receiver_ranks.item(new, p)].add(new)
+                    partner[p], husband[new] = new, p
+                    proposer_regret = max(proposer_regret, proposer_ranks.item(p, new))
+                eliminated[rotation] = True
+                chosen.append(rotation)
+
+            while receiver_regret >= 0 and not buckets[receiver_regret]:
+                receiver_regret -= 1
+            if max(proposer_regret, receiver_regret) < best_regret:
+                best_regret, best_length = max(proposer_regret, receiver_regret), len(chosen)
+
+        return chosen[:best_length]
+
+
+    def optimal_stable_matching(self, objective='egalitarian'):
+        """
+        A method that finds a stable matching that is best for the two sides together according to the given
+        objective, without listing the stable matchings one by one. The rotations of the problem are found as in
+        all_stable_matchings(), and the stable matching is scored through the integer rank tables, where an agent's
+        rank of their partner is the position of the partner on their preference list (0 for the first choice).
+
+        Input:
+
+        objective: Either 'egalitarian' (default) or 'min_regret'.
+                   'egalitarian' finds a stable matching that minimizes the sum of the ranks of the partners of all
+                   matched agents. It solves a minimum cut problem over the rotations (Irving, Leather and Gusfield
+                   (1987)).
+                   'min_regret' finds a stable matching that minimizes the largest rank any agent assigns to their
+                   partner, in time quadratic in the number of agents (Gusfield (1987)).
+
+        Returns a dictionary in the format Deferred_Acceptance() returns. If several stable matchings are optimal,
+        one of them is returned.
+
+        The model is compiled (see compile()) if it is not compiled yet.
+        """
+        if objective not in ('egalitarian', 'min_regret'):
+            raise ValueError('Not a valid argument was passed in objective.')
+
+        first, rotations, predecessors = self.__rotations()
+        compiled = self.compiled
+
+        if objective == 'egalitarian':
+            # the weight of a rotation is the change in the sum of the ranks when it is eliminated:
+            # proposers[i] leaves partners[i] for partners[i + 1], who leaves proposers[i + 1] for proposers[i]
+            weights = []
+            for proposers, partners in rotations:
+                new_partners, old_husbands = np.roll(partners, -1), np.roll(proposers, -1)
+                weights.append(int(compiled.rank(0, proposers, new_partners).sum(dtype=np.int64)
+                                   - compiled.rank(0, proposers, partners).sum(dtype=np.int64)
+                                   + compiled.rank(1, new_partners, proposers).sum(dtype=np.int64)
+                                   - compiled.rank(1, new_partners, old_husbands).sum(dtype=np.int64)))
+            chosen = self.__minimum_weight_closure(weights, predecessors)
         else:
-            return self.support, self.frequencies
+            chosen = self.__minimum_regret_rotations(first, rotations, predecessors)
+
+        # the chosen rotations are eliminated in the order they were found
+        partner = first.copy()
+        for rotation in sorted(chosen):
+            proposers, partners = rotations[rotation]
+            partner[proposers] = np.roll(partners, -1)
+        return compiled.decode_matching(partner)
+
+
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%% BATCHES %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+def batch_deferred_acceptance(proposer_preferences, receiver_preferences):
+    """
+    A function that runs Gale and Shapley's Deferred Acceptance algorithm on many independent problems of the same
+    size at once. The proposals of all problems are made together in every round with array operations, and a
+    problem stops taking part in the rounds as soon as it has no rejections left.
+
+    Input:
+
+    proposer_preferences: an integer array of shape (batch, number of proposers, length of the longest list), where
+                          proposer_preferences[b, i] is the preference list of proposer i in problem b written with
+                          the integer ids of the receivers of problem b (0, 1, ...). Shorter lists are padded with
+                          -1 at the end.
+    receiver_preferences: the same for the receivers; an integer array of shape
+                          (batch, number of receivers, length of the longest list).
+
+    Output: A 2-tuple of
+    - an integer array of shape (batch, number of proposers) holding the receiver every proposer is matched with
+      (-1 if the proposer is unmatched), and
+    - an integer array of shape (batch,) holding the number of rounds it took to solve each problem (counted as
+      Deferred_Acceptance() counts them).
+    """
+
+    proposer_preferences = np.asarray(proposer_preferences)
+    receiver_preferences = np.asarray(receiver_preferences)
+    if proposer_preferences.ndim != 3 or receiver_preferences.ndim != 3:
+        raise ValueError('The preferences of each side must be a 3D array of shape (batch, agents, list length).')
+    if len(proposer_preferences) != len(receiver_preferences):
+        raise ValueError('Both sides must have the same number of problems.')
+
+    batch, number_of_proposers, _ = proposer_preferences.shape
+    number_of_receivers = receiver_preferences.shape[1]
+    for preferences, others in ((proposer_preferences, number_of_receivers),
+                                (receiver_preferences, number_of_proposers)):
+        listed = preferences >= 0
+        if np.any((preferences >= others) | (preferences < -1)) or np.any(~listed[..., :-1] & listed[..., 1:]):
+            raise ValueError('The preference lists must hold the ids of the other side, padded with -1 at the end.')
+
+    # the problems are laid side by side: proposer i of problem b is proposer b * number_of_proposers + i, and
+    # receiver r of problem b is receiver b * number_of_receivers + r. the rank tables keep the ids of each problem
+    lengths = (proposer_preferences >= 0).sum(axis=2).ravel()
+    receiver_lengths = (receiver_preferences >= 0).sum(axis=2).ravel()
+    preferences = proposer_preferences.reshape(batch * number_of_proposers, proposer_preferences.shape[2])
+    dtype = np.int16 if receiver_preferences.shape[2] < np.iinfo(np.int16).max else np.int32
+    rank_table = np.full((batch, number_of_receivers, number_of_proposers), np.iinfo(dtype).max, dtype=dtype)
+    b, r, k = np.nonzero(receiver_preferences >= 0)
+    rank_table[b, r, receiver_preferences[b, r, k]] = k
+    rank_table = rank_table.reshape(batch * number_of_receivers, number_of_proposers)
+
+    next_choice = np.zeros(batch * number_of_proposers, dtype=np.int64)
+    holder = np.full(batch * number_of_receivers, -1, dtype=np.int64)
+    holder_rank = np.zeros(batch * number_of_receivers, dtype=np.int64)
+
+    # one round in every problem (see MarriageModel.__compiled_round); it returns the proposers who were rejected
+    def deferred_acceptance_round(free):
+        free = free[next_choice[free] < lengths[free]]
+        pointed = (free // number_of_proposers) * number_of_receivers + preferences[free, next_choice[free]]
+        next_choice[free] += 1
+
+        rank = rank_table[pointed, free % number_of_proposers]
+        acceptable = rank < receiver_lengths[pointed]
+        rejected = free[~acceptable]
+        free, pointed, rank = free[acceptable], pointed[acceptable], rank[acceptable]
+
+        holding = np.unique(pointed)
+        holding = holding[holder[holding] >= 0]
+        candidates = np.concatenate((free, holder[holding]))
+        receivers = np.concatenate((pointed, holding))
+        ranks = np.concatenate((rank, holder_rank[holding]))
+
+        order = np.lexsort((ranks, receivers))
+        candidates, receivers, ranks = candidates[order], receivers[order], ranks[order]
+        best = np.ones(len(receivers), dtype=bool)
+        best[1:] = receivers[1:] != receivers[:-1]
+        holder[receivers[best]] = candidates[best]
+        holder_rank[receivers[best]] = ranks[best]
+
+        return np.concatenate((rejected, candidates[~best]))
+
+    # the first round: every proposer proposes to their first choice
+    rounds = np.ones(batch, dtype=np.int64)
+    free = deferred_acceptance_round(np.arange(batch * number_of_proposers))
+
+    # iterate while there exist rejections in some problem; only the proposers of those problems can propose
+    active = np.ones(batch, dtype=bool)
+    while np.any(active):
+        free = deferred_acceptance_round(free)
+        rounds[active] += 1
+        free = free[next_choice[free] < lengths[free]]
+        active = np.zeros(batch, dtype=bool)
+        active[free // number_of_proposers] = True
+
+    partner = np.full(batch * number_of_proposers, -1, dtype=np.int64)
+    matched = np.flatnonzero(holder >= 0)
+    partner[holder[matched]] = matched % number_of_receivers
+    return partner.reshape(batch, number_of_proposers), rounds
+
+
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%% WORKER PROCESSES %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+# the model a worker process works on; it is sent once to every worker when the process pool starts
+_worker_model = None
+
+
+def _set_worker_model(model):
+    global _worker_model
+    _worker_model = model
+
+
+# one random path to stability of the worker's model, seeded by a np.random.SeedSequence
+def _random_path(seed, kwargs):
+    return _worker_model._MarriageModel__random_path(np.random.default_rng(seed), **kwargs)
+
+
+class _RoundWorkers:
+
+    """
+    The worker processes of the parallel engine of Deferred_Acceptance(). The arrays of the receiving side of the
+    compiled preferences, what every receiver holds and the proposals of the current round are kept in shared
+    memory. The receivers are split into n_jobs blocks of consecutive ids, and in every round each worker resolves
+    the proposals made to its own block (see MarriageModel.__resolve_proposals()), so that no two workers write to
+    the same entry. It is a context manager; the shared memory is released when it exits.
+    """
+
+    # the number of proposals below which a round is resolved in the main process
+    min_proposals = 2**14
+
+    def __init__(self, compiled, n_jobs=None):
+        self.n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+        self.size = compiled.size
+        self.shared = []
+
+        arrays = {name: getattr(compiled, name)[1] for name in compiled._arrays}
+        self.holder = self.__allocate(arrays, 'holder', compiled.size[1])
+        self.holder_rank = self.__allocate(arrays, 'holder_rank', compiled.size[1])
+        self.free = self.__allocate(arrays, 'free', compiled.size[0])
+        self.pointed = self.__allocate(arrays, 'pointed', compiled.size[0])
+        self.rejected = self.__allocate(arrays, 'rejected', compiled.size[0])
+        self.holder[:] = -1
+
+        # the arrays of the compiled preferences are copied into shared memory as well
+        layout = {}
+        for name, array in arrays.items():
+            if not isinstance(array, _SharedArray):
+                array = np.asarray(array)
+                shared = _SharedArray(array.shape, array.dtype)
+                shared.array[...] = array
+                arrays[name] = shared
+                self.shared.append(shared)
+            layout[name] = arrays[name].layout
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.n_jobs, initializer=_attach_round_arrays, initargs=(type(compiled), compiled.size, layout))
+
+
+    # allocates an int64 array of the given length in shared memory and registers it under the given name
+    def __allocate(self, arrays, name, length):
+        shared = _SharedArray((length,), np.int64)
+        arrays[name] = shared
+        self.shared.append(shared)
+        return shared.array
+
+
+    # resolves the proposals of a round (free[i] proposes to pointed[i]) in the worker processes and returns the
+    # rejected proposers
+    def resolve(self, free, pointed):
+        # the proposals are grouped by the block of their receiver (with a stable sort of the block numbers)
+        block = pointed.astype(np.int64) * self.n_jobs // max(self.size[1], 1)
+        order = np.argsort(block, kind='stable')
+        bounds = np.concatenate(([0], np.cumsum(np.bincount(block, minlength=self.n_jobs))))
+        self.free[:len(free)] = free[order]
+        self.pointed[:len(free)] = pointed[order]
+
+        # every worker writes the proposers its receivers rejected where its proposals were (there are never more)
+        futures = [(start, self.executor.submit(_resolve_round_block, start, end))
+                   for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()) if end > start]
+        return np.concatenate([self.rejected[start:start + future.result()] for start, future in futures]
+                              + [np.zeros(0, dtype=np.int64)])
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def close(self):
+        self.executor.shutdown()
+        self.holder = self.holder_rank = self.free = self.pointed = self.rejected = None
+        for shared in self.shared:
+            shared.release()
+        self.shared = []
+
+
+class _SharedArray:
+
+    """
+    A numpy array in a block of shared memory, which worker processes attach to by the layout.
+    """
+
+    def __init__(self, shape, dtype, name=None):
+        dtype = np.dtype(dtype)
+        size = max(1, int(np.prod(shape, dtype=np.int64)) * dtype.itemsize)
+        self.memory = multiprocessing.shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.memory.buf)
+        self.layout = (self.memory.name, shape, dtype.str)
+
+
+    # frees the block (the workers detach from it when they exit)
+    def release(self):
+        self.array = None
+        self.memory.unlink()
+        try:
+            self.memory.close()
+        # (an array may still be referenced by a traceback; the memory is freed when it is collected)
+        except BufferError:
+            pass
+
+
+# the compiled preferences of the receiving side and the shared arrays of the parallel engine in a worker process
+_worker_round = None
+
+
+def _attach_round_arrays(kind, size, layout):
+    global _worker_round
+    shared = {name: _SharedArray(shape, dtype, name=memory) for name, (memory, shape, dtype) in layout.items()}
+    arrays = {name: array.array for name, array in shared.items()}
+    # only the receiving side of the compiled preferences is needed (see MarriageModel.__resolve_proposals())
+    compiled = kind.__new__(kind)
+    compiled.size = size
+    for name in kind._arrays:
+        setattr(compiled, name, (None, arrays[name]))
+    _worker_round = (compiled, arrays, shared)
+
+
+# resolves the proposals free[start:end] to pointed[start:end] of the current round, which are all made to the
+# worker's block of receivers, and writes the rejected proposers to rejected[start:]
+def _resolve_round_block(start, end):
+    compiled, arrays, _ = _worker_round
+    rejected = MarriageModel._MarriageModel__resolve_proposals(compiled, arrays['free'][start:end],
+                                                               arrays['pointed'][start:end], arrays['holder'],
+                                                               arrays['holder_rank'])
+    arrays['rejected'][start:start + len(rejected)] = rejected
+    return len(rejected)
@@ -0,0 +1,311 @@
+"""
+Benchmarks for StableMarriage.
+
+The instance generators below build seeded random markets as padded integer preference arrays (the format of
+CompiledPreferences.from_arrays() and batch_deferred_acceptance()), and run() times the public methods of
+MarriageModel on every kind of market across a sweep of sizes. Every result records the time it took, the number of
+proposals and rounds (from MarriageModel.stats, for the methods that make them) and the peak memory use, and save()
+writes the results as JSON together with the commit they were measured on, so that two runs can be compared with
+compare().
+
+Usage (from the repository root):
+
+    python benchmark.py --sizes 100 200 400 --output before.json
+    python benchmark.py --sizes 100 200 400 --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+from StableMarriage import MarriageModel, batch_deferred_acceptance
+
+
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%% GENERATORS %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+# every generator returns the preference arrays of the proposers and of the receivers: row i is the preference list
+# of agent i written with the integer ids of the other side, padded with -1 at the end. seed is anything
+# np.random.default_rng accepts
+
+def uniform(number_of_proposers, number_of_receivers, seed=None):
+    """
+    Complete preference lists drawn uniformly at random and independently for every agent.
+    """
+    rng = np.random.default_rng(seed)
+    return (rng.random((number_of_proposers, number_of_receivers)).argsort(axis=1).astype(np.int32),
+            rng.random((number_of_receivers, number_of_proposers)).argsort(axis=1).astype(np.int32))
+
+
+def truncated(number_of_proposers, number_of_receivers, length=10, seed=None):
+    """
+    Preference lists of (at most) the given length: every agent ranks that many agents of the other side, drawn
+    uniformly at random, in a uniformly random order.
+    """
+    rng = np.random.default_rng(seed)
+    return tuple(rng.random((rows, columns)).argsort(axis=1)[:, :length].astype(np.int32)
+                 for rows, columns in ((number_of_proposers, number_of_receivers),
+                                       (number_of_receivers, number_of_proposers)))
+
+
+def master_list(number_of_proposers, number_of_receivers, noise=0.0, seed=None):
+    """
+    Complete preference lists that follow a master list of each side: the agents of a side are ranked by a common
+    score (drawn once) plus independent normal noise with the given standard deviation, so that noise=0 gives
+    identical preference lists and a large noise gives the uniform case.
+    """
+    rng = np.random.default_rng(seed)
+    return tuple((-(rng.random(columns) + noise * rng.standard_normal((rows, columns)))).argsort(axis=1)
+                 .astype(np.int32) for rows, columns in ((number_of_proposers, number_of_receivers),
+                                                         (number_of_receivers, number_of_proposers)))
+
+
+# draws a Mallows permutation of range(n) for every row around the identity, with the repeated insertion model:
+# item i is inserted with v of the items before it behind it, where P(v) is proportional to dispersion ** v
+# (v = 0, ..., i). it returns the items of every row in order
+def _mallows_permutations(rows, n, dispersion, rng):
+    position = np.zeros((rows, n), dtype=np.int64)
+    for i in range(n):
+        u = rng.random(rows)
+        if dispersion >= 1:
+            behind = np.floor(u * (i + 1)).astype(np.int64)
+        elif dispersion <= 0:
+            behind = np.zeros(rows, dtype=np.int64)
+        else:
+            behind = np.floor(np.log1p(-u * (1 - dispersion ** (i + 1))) / np.log(dispersion)).astype(np.int64)
+        slot = i - np.minimum(behind, i)
+        # the items at or after the slot move back by one
+        position[:, :i] += position[:, :i] >= slot[:, None]
+        position[:, i] = slot
+    return position.argsort(axis=1)
+
+
+def mallows(number_of_proposers, number_of_receivers, dispersion=0.5, seed=None):
+    """
+    Complete preference lists drawn from a Mallows model around a reference list of each side (drawn uniformly at
+    random once): dispersion=0 gives the reference list to everyone and dispersion=1 gives the uniform case.
+    """
+    rng = np.random.default_rng(seed)
+    preferences = []
+    for rows, columns in ((number_of_proposers, number_of_receivers), (number_of_receivers, number_of_proposers)):
+        reference = rng.permutation(columns)
+        preferences.append(reference[_mallows_permutations(rows, columns, dispersion, rng)].astype(np.int32))
+    return tuple(preferences)
+
+
+def unbalanced(number_of_receivers, ratio=1.1, seed=None):
+    """
+    Uniform complete preference lists on a market with ratio times as many proposers as receivers (rounded up, and
+    at least one more): the proposers left over on the long side stay single, so Deferred Acceptance only stops once
+    they have proposed to every receiver, and it makes far more proposals than on a balanced market.
+    """
+    number_of_proposers = max(number_of_receivers + 1, int(np.ceil(ratio * number_of_receivers)))
+    return uniform(number_of_proposers, number_of_receivers, seed)
+
+
+# the markets run() sweeps over: a name and a function that generates the market of size n with a seed
+SCENARIOS = {'uniform': lambda n, seed: uniform(n, n, seed=seed),
+             'truncated': lambda n, seed: truncated(n, n, seed=seed),
+             'master_list': lambda n, seed: master_list(n, n, noise=0.1, seed=seed),
+             'mallows': lambda n, seed: mallows(n, n, seed=seed),
+             'unbalanced': lambda n, seed: unbalanced(n, seed=seed)}
+
+
+# writes preference arrays as the preference profiles MarriageModel takes (proposers are labelled p0, p1, ... and
+# receivers r0, r1, ...)
+def to_profiles(proposer_preferences, receiver_preferences):
+    profiles = []
+    for preferences, own, other in ((proposer_preferences, 'p', 'r'), (receiver_preferences, 'r', 'p')):
+        profiles.append({'{}{}'.format(own, i): ['{}{}'.format(other, j) for j in row[row >= 0].tolist()]
+                         for i, row in enumerate(preferences)})
+    return tuple(profiles)
+
+
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%% HARNESS %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+#%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+# the methods run() times. every method is given the profiles and returns a fresh model together with a function
+# that runs the method on it once (models are built outside of the timings); max_size is the largest size a method is
+# timed at (a random path to stability can take exponentially many steps on complete lists, so it is only timed on
+# small markets)
+def _deferred_acceptance(compiled, **kwargs):
+    def method(profiles, matching):
+        model = MarriageModel(*profiles, compiled=compiled)
+        return model, lambda: model.Deferred_Acceptance(**kwargs)
+    return method
+
+
+def _is_stable(compiled):
+    def method(profiles, matching):
+        model = MarriageModel(*profiles, compiled=compiled)
+        return model, lambda: model.is_stable(matching)
+    return method
+
+
+def _audit_stability(profiles, matching):
+    model = MarriageModel(*profiles, compiled=True)
+    return model, lambda: model.audit_stability(matching)
+
+
+def _random_path_to_stability(profiles, matching):
+    model = MarriageModel(*profiles, compiled=True)
+    return model, lambda: model.random_path_to_stability(seed=0)
+
+
+def _compile(profiles, matching):
+    model = MarriageModel(*profiles)
+    return model, model.compile
+
+
+# batch_deferred_acceptance() on a stack of 8 copies of the market
+def _batch_deferred_acceptance(profiles, matching):
+    model = MarriageModel(*profiles, compiled=True)
+    stacks = [np.repeat(np.asarray(model.compiled.preferences[side])[None], 8, axis=0) for side in (0, 1)]
+    return model, lambda: batch_deferred_acceptance(*stacks)
+
+
+def _optimal_stable_matching(objective):
+    def method(profiles, matching):
+        model = MarriageModel(*profiles, compiled=True)
+        return model, lambda: model.optimal_stable_matching(objective)
+    return method
+
+
+METHODS = {'Deferred_Acceptance': (_deferred_acceptance(False), None),
+           'Deferred_Acceptance[compiled]': (_deferred_acceptance(True), None),
+           'Deferred_Acceptance[queue]': (_deferred_acceptance(True, engine='queue'), None),
+           'Deferred_Acceptance[sparse]': (_deferred_acceptance('sparse'), None),
+           'Deferred_Acceptance[parallel]': (_deferred_acceptance(True, engine='parallel', n_jobs=2), None),
+           'batch_deferred_acceptance': (_batch_deferred_acceptance, None),
+           'compile': (_compile, None),
+           'is_stable': (_is_stable(False), None),
+           'is_stable[compiled]': (_is_stable(True), None),
+           'audit_stability': (_audit_stability, None),
+           'optimal_stable_matching[egalitarian]': (_optimal_stable_matching('egalitarian'), None),
+           'optimal_stable_matching[min_regret]': (_optimal_stable_matching('min_regret'), None),
+           'random_path_to_stability': (_random_path_to_stability, 16)}
+
+
+# runs a method once and returns the peak memory it allocated (in bytes)
+def _peak_memory(call):
+    tracemalloc.start()
+    try:
+        call()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(sizes=(100, 200, 400), scenarios=None, methods=None, repeat=3, seed=0, verbose=False):
+    """
+    Times the given methods (names of METHODS, all of them by default) on the given markets (names of SCENARIOS,
+    all of them by default) for every size, and returns a list of results (Python dictionaries) with the keys
+    'scenario', 'size', 'number_of_proposers', 'number_of_receivers', 'method', 'seconds' (the best of repeat runs),
+    'proposals' and 'rounds' (from the RunStats the method stores in MarriageModel.stats; None for the methods that
+    store none) and 'peak_memory' (in bytes, measured by tracemalloc in a separate run). The markets are generated with
+    the given seed, so two runs time the same instances; the stability checks are timed on the proposer-optimal stable
+    matching. A method is skipped on the sizes above its max_size (see METHODS).
+    """
+    scenarios = list(SCENARIOS) if scenarios is None else scenarios
+    methods = list(METHODS) if methods is None else methods
+    for name in scenarios:
+        if name not in SCENARIOS:
+            raise ValueError('{} is not a scenario. The scenarios are {}.'.format(name, ', '.join(SCENARIOS)))
+    for name in methods:
+        if name not in METHODS:
+            raise ValueError('{} is not a method. The methods are {}.'.format(name, ', '.join(METHODS)))
+
+    results = []
+    for scenario in scenarios:
+        for size in sizes:
+            preferences = SCENARIOS[scenario](size, seed)
+            number_of_proposers, number_of_receivers = len(preferences[0]), len(preferences[1])
+            profiles = to_profiles(*preferences)
+            matching = MarriageModel(*profiles, compiled=True).Deferred_Acceptance()
+
+            for name in methods:
+                setup, max_size = METHODS[name]
+                if max_size is not None and size > max_size:
+                    continue
+                timings = []
+                for _ in range(repeat):
+                    model, call = setup(profiles, matching)
+                    start = time.perf_counter()
+                    call()
+                    timings.append(time.perf_counter() - start)
+                peak = _peak_memory(setup(profiles, matching)[1])
+
+                stats = model.stats
+                result = {'scenario': scenario, 'size': size, 'number_of_proposers': number_of_proposers,
+                          'number_of_receivers': number_of_receivers, 'method': name, 'seconds': min(timings),
+                          'proposals': stats.proposals if stats is not None else None,
+                          'rounds': stats.rounds if stats is not None else None, 'peak_memory': peak}
+                results.append(result)
+                if verbose:
+                    print('{:12s} {:6d} {:30s} {:10.4f}s  proposals {}  rounds {}  peak memory {:.1f} MB'
+                          .format(scenario, size, name, result['seconds'], result['proposals'], result['rounds'],
+                                  peak / 1e6))
+    return results
+
+
+# the commit the working tree is on (None outside of a git repository)
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(results, path, seed=0, repeat=3):
+    """
+    Writes the results of run() to a JSON file together with the commit, the seed, the number of repeats and the
+    versions of Python and NumPy they were measured with.
+    """
+    document = {'commit': _commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'seed': seed, 'repeat': repeat,
+                'python': platform.python_version(), 'numpy': np.__version__, 'results': results}
+    with open(path, 'w') as file:
+        json.dump(document, file, indent=2)
+
+
+def compare(before, after):
+    """
+    Compares two JSON files written by save() and returns a list of (scenario, size, method, seconds before,
+    seconds after, ratio of the two) for every result they have in common; a ratio below 1 means that the method got
+    faster.
+    """
+    documents = []
+    for path in (before, after):
+        with open(path) as file:
+            documents.append({(r['scenario'], r['size'], r['method']): r for r in json.load(file)['results']})
+    return [key + (documents[0][key]['seconds'], documents[1][key]['seconds'],
+                   documents[1][key]['seconds'] / max(documents[0][key]['seconds'], 1e-12))
+            for key in documents[1] if key in documents[0]]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Times the methods of MarriageModel on synthetic markets.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 200, 400])
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=None)
+    parser.add_argument('--methods', nargs='+', choices=list(METHODS), default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', default=None, help='a JSON file of an earlier run to compare the results with')
+    args = parser.parse_args(args)
+
+    results = run(args.sizes, args.scenarios, args.methods, args.repeat, args.seed, verbose=True)
+    save(results, args.output, args.seed, args.repeat)
+    if args.compare is not None:
+        for scenario, size, method, before, after, ratio in compare(args.compare, args.output):
+            print('{:12s} {:6d} {:30s} {:10.4f}s -> {:10.4f}s  ({:.2f}x)'
+                  .format(scenario, size, method, before, after, ratio))
+
+
+if __name__ == '__main__':
+    main()
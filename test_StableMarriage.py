@@ -0,0 +1,669 @@
+import functools
+import io
+import json
+import random
+import warnings
+import numpy as np
+import pytest
+import StableMarriage
+from StableMarriage import (CompiledPreferences, JSONLinesLogger, MarriageModel, Matching, RoundRecorder,
+                            SparsePreferences, batch_deferred_acceptance)
+
+
+# seeded random markets of 2 to 7 agents per side, with incomplete (but never empty) or complete preference lists
+def market(seed, smallest=2, largest=7, complete=False):
+    rng = random.Random(seed)
+    proposers = ['m{}'.format(i) for i in range(rng.randint(smallest, largest))]
+    receivers = ['w{}'.format(i) for i in range(rng.randint(smallest, largest))]
+    return ({p: rng.sample(receivers, len(receivers) if complete else rng.randint(1, len(receivers)))
+             for p in proposers},
+            {r: rng.sample(proposers, len(proposers) if complete else rng.randint(1, len(proposers)))
+             for r in receivers})
+
+
+MARKETS = [market(seed, complete=seed % 3 == 0) for seed in range(60)]
+
+
+def pairs(mu, proposers):
+    return {(p, mu[p]) for p in proposers if mu.get(p) is not None}
+
+
+def dict_deferred_acceptance(proposers, receivers):
+    return pairs(MarriageModel(proposers, receivers).Deferred_Acceptance(), proposers)
+
+
+# a random matching of mutually acceptable pairs, in the form Deferred_Acceptance() returns (every proposer with their
+# partner or None, and the single receivers with None)
+def random_matching(rng, proposers, receivers):
+    mu = dict.fromkeys(proposers)
+    taken = set()
+    for p in rng.sample(list(proposers), len(proposers)):
+        choices = [r for r in proposers[p] if r not in taken and p in receivers[r]]
+        if choices and rng.random() < 0.8:
+            mu[p] = rng.choice(choices)
+            taken.add(mu[p])
+    mu.update((r, None) for r in receivers if r not in taken)
+    return mu
+
+
+def outcome(model, mu):
+    try:
+        return model.is_stable(mu)
+    except Exception as e:
+        return type(e), str(e)
+
+
+@pytest.mark.parametrize('proposers, receivers', MARKETS)
+def test_compiled_deferred_acceptance_agrees_with_dict_deferred_acceptance(proposers, receivers):
+    model = MarriageModel(proposers, receivers, compiled=True)
+    assert pairs(model.Deferred_Acceptance(), proposers) == dict_deferred_acceptance(proposers, receivers)
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_compiled_is_stable_agrees_with_dict_is_stable(seed):
+    proposers, receivers = MARKETS[seed]
+    rng = random.Random(seed)
+    dict_model = MarriageModel(proposers, receivers)
+    compiled_model = MarriageModel(proposers, receivers, compiled=True)
+    matchings = [dict_model.Deferred_Acceptance()] + [random_matching(rng, proposers, receivers) for _ in range(10)]
+    # (and a pair that is not on the proposer's list, which both report as the same error)
+    p = rng.choice(list(proposers))
+    r = next((r for r in receivers if r not in proposers[p]), None)
+    if r is not None:
+        matchings.append({p: r})
+    for mu in matchings:
+        assert outcome(compiled_model, dict(mu)) == outcome(dict_model, dict(mu))
+
+
+@pytest.mark.parametrize('proposers, receivers', MARKETS)
+def test_queue_engine_agrees_with_dict_deferred_acceptance(proposers, receivers, capsys):
+    MarriageModel(proposers, receivers).Deferred_Acceptance(print_rounds=True)
+    rounds = capsys.readouterr().out
+    model = MarriageModel(proposers, receivers)
+    assert pairs(model.Deferred_Acceptance(engine='queue', print_rounds=True), proposers) == \
+        dict_deferred_acceptance(proposers, receivers)
+    # (the model is compiled on the way, and both engines count the rounds the same way)
+    assert model.compiled is not None
+    assert capsys.readouterr().out == rounds
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        MarriageModel(*MARKETS[0]).Deferred_Acceptance(engine='stack')
+
+
+# every blocking pair of a matching in the form Deferred_Acceptance() returns, pair by pair
+def brute_force_blocking_pairs(mu, proposers, receivers):
+    partner = {p: r for p, r in mu.items() if p in proposers}
+    partner.update([(r, p) for p, r in partner.items() if r is not None])
+
+    def prefers(agent, other, choices):
+        return partner.get(agent) is None or choices.index(other) < choices.index(partner[agent])
+
+    return {(p, r) for p, choices in proposers.items() for r in choices
+            if p in receivers[r] and partner.get(p) != r
+            and prefers(p, r, choices) and prefers(r, p, receivers[r])}
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_audit_stability_agrees_with_brute_force(seed):
+    proposers, receivers = MARKETS[seed]
+    rng = random.Random(seed)
+    model = MarriageModel(proposers, receivers)
+    for mu in [model.Deferred_Acceptance()] + [random_matching(rng, proposers, receivers) for _ in range(10)]:
+        expected = brute_force_blocking_pairs(mu, proposers, receivers)
+        audit = model.audit_stability(mu, return_mask=True)
+        assert set(audit['blocking_pairs']) == expected
+        assert audit['number_of_blocking_pairs'] == len(expected)
+        assert audit['stable'] == (not expected) == (model.is_stable(mu) is True)
+        if not audit['stable']:
+            assert model.is_stable(mu) in expected
+        for side, counts in ((0, audit['proposer_counts']), (1, audit['receiver_counts'])):
+            assert counts == {agent: sum(pair[side] == agent for pair in expected)
+                              for agent in {pair[side] for pair in expected}}
+        labels = model.compiled.labels
+        assert {(labels[0][p], labels[1][r]) for p, r in zip(*audit['mask'].nonzero())} == expected
+
+
+def test_is_stable_on_more_than_256_couples():
+    proposers = {'m{}'.format(i): ['w{}'.format(i)] for i in range(300)}
+    receivers = {'w{}'.format(i): ['m{}'.format(i)] for i in range(300)}
+    model = MarriageModel(proposers, receivers)
+    assert model.is_stable(model.Deferred_Acceptance()) is True
+
+
+# (balanced markets with complete lists often have several stable matchings, and this one has three)
+LATIN_SQUARE = ({'m0': ['w0', 'w1', 'w2'], 'm1': ['w1', 'w2', 'w0'], 'm2': ['w2', 'w0', 'w1']},
+                {'w0': ['m1', 'm2', 'm0'], 'w1': ['m2', 'm0', 'm1'], 'w2': ['m0', 'm1', 'm2']})
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_random_paths_are_reproducible_whatever_the_number_of_workers(compiled):
+    model = MarriageModel(*LATIN_SQUARE, compiled=compiled)
+    support, frequencies = model.random_path_to_stability(40, seed=7)
+    for n_jobs in (1, 2, 3):
+        other, other_frequencies = model.random_path_to_stability(40, seed=7, n_jobs=n_jobs)
+        assert other == support and np.array_equal(other_frequencies, frequencies)
+    assert frequencies.sum() == 40
+    assert all(model.is_stable(mu) is True for mu in support)
+    assert model.random_path_to_stability(seed=7) in support
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('compiled', [False, True])
+def test_random_paths_end_in_stable_matchings(seed, compiled):
+    proposers, receivers = MARKETS[seed]
+    model = MarriageModel(proposers, receivers, compiled=compiled)
+    support, frequencies = model.random_path_to_stability(10, seed=seed)
+    assert frequencies.sum() == 10
+    for mu in support:
+        # (the support lists the single agents as 'unmatched')
+        mu = {str(agent): None if partner == 'unmatched' else str(partner) for agent, partner in mu.items()}
+        assert model.audit_stability(mu)['stable'] and model.is_stable(mu) is True
+
+
+def test_random_paths_with_labels_made_at_run_time():
+    # (labels built at run time are equal but not identical to one another, so they must be compared with ==)
+    label = lambda name: ''.join(list(name))
+    proposers, receivers = LATIN_SQUARE
+    model = MarriageModel({label(p): [label(r) for r in choices] for p, choices in proposers.items()},
+                          {label(r): [label(p) for p in choices] for r, choices in receivers.items()})
+    support, _ = model.random_path_to_stability(20, seed=0)
+    assert all(model.is_stable(mu) is True for mu in support)
+
+
+# every stable matching of a market, as a set of pairs, by enumerating all matchings of mutually acceptable pairs
+def brute_force_stable_matchings(proposers, receivers):
+    acceptable = {p: [r for r in choices if p in receivers[r]] for p, choices in proposers.items()}
+    order = list(proposers)
+    stable = []
+
+    def extend(i, matched, taken):
+        if i == len(order):
+            mu = dict(matched)
+            mu.update((r, None) for r in receivers if r not in taken)
+            if not brute_force_blocking_pairs(mu, proposers, receivers):
+                stable.append(frozenset(matched))
+            return
+        extend(i + 1, matched + [(order[i], None)], taken)
+        for r in acceptable[order[i]]:
+            if r not in taken:
+                extend(i + 1, matched + [(order[i], r)], taken | {r})
+
+    extend(0, [], frozenset())
+    return [frozenset(pair for pair in matched if pair[1] is not None) for matched in stable]
+
+
+STABLE_MATCHING_MARKETS = ([LATIN_SQUARE] + [market(seed, 2, 6) for seed in range(20)]
+                           + [market(seed, size, size, complete=True) for seed in range(10) for size in (4, 5, 6)])
+
+
+# (the enumeration is the slow part of these tests, so it is done once per market)
+@functools.lru_cache(maxsize=None)
+def stable_matchings_of(index):
+    return brute_force_stable_matchings(*STABLE_MATCHING_MARKETS[index])
+
+
+@pytest.mark.parametrize('index', range(len(STABLE_MATCHING_MARKETS)))
+def test_all_stable_matchings_agrees_with_brute_force(index):
+    proposers, receivers = STABLE_MATCHING_MARKETS[index]
+    expected = stable_matchings_of(index)
+    listed = [frozenset(pairs(mu, proposers)) for mu in MarriageModel(proposers, receivers).all_stable_matchings()]
+    assert len(listed) == len(set(listed))
+    assert set(listed) == set(expected)
+    assert listed[0] == frozenset(dict_deferred_acceptance(proposers, receivers))
+
+
+def ranks(matched, proposers, receivers):
+    return [proposers[p].index(r) for p, r in matched] + [receivers[r].index(p) for p, r in matched]
+
+
+@pytest.mark.parametrize('index', range(len(STABLE_MATCHING_MARKETS)))
+@pytest.mark.parametrize('objective, cost', [('egalitarian', sum),
+                                             ('min_regret', lambda values: max(values, default=0))])
+def test_optimal_stable_matching_agrees_with_brute_force(index, objective, cost):
+    proposers, receivers = STABLE_MATCHING_MARKETS[index]
+    expected = stable_matchings_of(index)
+    mu = frozenset(pairs(MarriageModel(proposers, receivers).optimal_stable_matching(objective), proposers))
+    assert mu in expected
+    assert cost(ranks(mu, proposers, receivers)) == min(cost(ranks(matched, proposers, receivers))
+                                                        for matched in expected)
+
+
+def test_unknown_objective():
+    with pytest.raises(ValueError):
+        MarriageModel(*LATIN_SQUARE).optimal_stable_matching('utilitarian')
+
+
+# a market with receivers that have capacities, and the same market with every receiver cloned into one receiver per
+# slot (with the receiver's list, and in the receiver's place on every proposer's list)
+def capacitated_market(seed):
+    rng = random.Random(seed)
+    proposers, receivers = market(seed, 3, 7)
+    capacities = {r: rng.randint(0, 3) for r in receivers}
+    slots = {r: ['{}#{}'.format(r, k) for k in range(capacity)] for r, capacity in capacities.items()}
+    cloned = ({p: [slot for r in choices for slot in slots[r]] for p, choices in proposers.items()},
+              {slot: receivers[r] for r in receivers for slot in slots[r]})
+    return proposers, receivers, capacities, slots, cloned
+
+
+# the assignment of a cloned matching, and a cloned matching of an assignment (the best proposer of a receiver in its
+# first slot, and so on)
+def fold(mu, receivers, slots):
+    return {r: sorted((p for slot in slots[r] for p, held in mu.items() if held == slot), key=receivers[r].index)
+            for r in receivers}
+
+
+def unfold(assignment, proposers, slots):
+    mu = dict.fromkeys(proposers)
+    for r, held in assignment.items():
+        if r in slots:
+            mu.update(zip(held, slots[r]))
+    return mu
+
+
+def random_assignment(rng, proposers, receivers, capacities):
+    assignment = {r: [] for r in receivers}
+    for p in rng.sample(list(proposers), len(proposers)):
+        choices = [r for r in proposers[p] if len(assignment[r]) < capacities[r] and p in receivers[r]]
+        if choices and rng.random() < 0.8:
+            assignment[rng.choice(choices)].append(p)
+    return {r: sorted(held, key=receivers[r].index) for r, held in assignment.items()}
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_capacities_agree_with_cloned_receivers(seed):
+    proposers, receivers, capacities, slots, cloned = capacitated_market(seed)
+    model = MarriageModel(proposers, receivers, capacities=capacities)
+    cloned_model = MarriageModel(*cloned, compiled=True)
+    assignment = model.Deferred_Acceptance()
+    assert {r: held for r, held in assignment.items() if r in receivers} == \
+        fold(cloned_model.Deferred_Acceptance(), receivers, slots)
+    assert {p for p in proposers if assignment.get(p, 0) is None} == \
+        {p for p in proposers if all(p not in held for held in assignment.values() if held)}
+
+    rng = random.Random(seed)
+    for assignment in [assignment] + [random_assignment(rng, proposers, receivers, capacities) for _ in range(10)]:
+        mu = unfold(assignment, proposers, slots)
+        expected = {(p, slot.split('#')[0]) for p, slot in brute_force_blocking_pairs(mu, *cloned)}
+        audit = model.audit_stability(assignment)
+        assert set(audit['blocking_pairs']) == expected
+        assert (model.is_stable(assignment) is True) == (not expected)
+        if expected:
+            assert model.is_stable(assignment) in expected
+
+
+def test_capacities_are_checked():
+    proposers, receivers, capacities, slots, cloned = capacitated_market(0)
+    with pytest.raises(ValueError):
+        MarriageModel(proposers, receivers, capacities={'nobody': 1})
+    with pytest.raises(ValueError):
+        MarriageModel(proposers, receivers, capacities={r: -1 for r in receivers})
+    model = MarriageModel(proposers, receivers, capacities=capacities)
+    full = max(receivers, key=capacities.get)
+    with pytest.raises(ValueError):
+        model.is_stable({full: list(proposers)[:capacities[full] + 1]})
+    with pytest.raises(ValueError):
+        model.random_path_to_stability()
+
+
+@pytest.mark.parametrize('size', [2, 4, 7])
+def test_batch_deferred_acceptance_agrees_with_dict_deferred_acceptance(size, capsys):
+    markets = [market(seed, size, size) for seed in range(20)]
+    arrays = []
+    for side in (0, 1):
+        table = np.full((len(markets), size, size), -1, dtype=np.int64)
+        for b, profiles in enumerate(markets):
+            for i, choices in enumerate(profiles[side].values()):
+                table[b, i, :len(choices)] = [int(agent[1:]) for agent in choices]
+        arrays.append(table)
+    partner, rounds = batch_deferred_acceptance(*arrays)
+    for b, (proposers, receivers) in enumerate(markets):
+        assert ({('m{}'.format(i), 'w{}'.format(r)) for i, r in enumerate(partner[b].tolist()) if r >= 0}
+                == dict_deferred_acceptance(proposers, receivers))
+        capsys.readouterr()
+        MarriageModel(proposers, receivers).Deferred_Acceptance(print_rounds=True)
+        assert 'ran {} round'.format(rounds[b]) in capsys.readouterr().out
+
+
+def test_batch_deferred_acceptance_checks_the_shapes():
+    with pytest.raises(ValueError):
+        batch_deferred_acceptance(np.zeros((2, 3, 3), dtype=np.int64), np.zeros((3, 3, 3), dtype=np.int64))
+    with pytest.raises(ValueError):
+        batch_deferred_acceptance(np.zeros((3, 3), dtype=np.int64), np.zeros((3, 3), dtype=np.int64))
+
+
+def changes(seed, proposers, receivers):
+    rng = random.Random(seed)
+    agent = rng.choice(list(proposers) + list(receivers))
+    others = receivers if agent in proposers else proposers
+    yield 'update_preferences', (agent, rng.sample(list(others), rng.randint(1, len(others))))
+    yield 'add_proposer', ('new', rng.sample(list(receivers), rng.randint(1, len(receivers))))
+    yield 'add_receiver', ('new', rng.sample(list(proposers), rng.randint(1, len(proposers))))
+    if len(proposers) > 2:
+        yield 'remove_proposer', (rng.choice(list(proposers)),)
+    if len(receivers) > 2:
+        yield 'remove_receiver', (rng.choice(list(receivers)),)
+
+
+# the preference profiles after a change
+def changed(method, arguments, proposers, receivers):
+    proposers, receivers = dict(proposers), dict(receivers)
+    if method == 'update_preferences':
+        agent, preferences = arguments
+        (proposers if agent in proposers else receivers)[agent] = preferences
+    elif method == 'add_proposer':
+        proposers[arguments[0]] = arguments[1]
+    elif method == 'add_receiver':
+        receivers[arguments[0]] = arguments[1]
+    elif method == 'remove_proposer':
+        del proposers[arguments[0]]
+        receivers = {r: [p for p in choices if p != arguments[0]] for r, choices in receivers.items()}
+    else:
+        del receivers[arguments[0]]
+        proposers = {p: [r for r in choices if r != arguments[0]] for p, choices in proposers.items()}
+    return proposers, receivers
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_warm_start_agrees_with_fresh_solve(seed):
+    proposers, receivers = MARKETS[seed]
+    for method, arguments in changes(seed, proposers, receivers):
+        model = MarriageModel(proposers, receivers, compiled=True)
+        model.Deferred_Acceptance(engine='queue')
+        getattr(model, method)(*arguments)
+        expected = changed(method, arguments, proposers, receivers)
+        fresh = MarriageModel(*expected, compiled=True).Deferred_Acceptance(engine='queue')
+        assert pairs(model.Deferred_Acceptance(engine='queue'), expected[0]) == pairs(fresh, expected[0])
+        # (adding an agent keeps every proposal made before)
+        assert model.proposals_saved > 0 if method.startswith('add') else model.proposals_saved >= 0
+
+
+def write_csv(path, profile, delimiter=','):
+    with open(path, 'w') as file:
+        file.writelines(delimiter.join([agent] + choices) + '\n' for agent, choices in profile.items())
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_compiled_preferences_from_csv_npy_and_saved_directories(seed, tmp_path):
+    proposers, receivers = MARKETS[seed]
+    expected = dict_deferred_acceptance(proposers, receivers)
+    write_csv(tmp_path / 'proposers.tsv', proposers, '\t')
+    write_csv(tmp_path / 'receivers.tsv', receivers, '\t')
+    compiled = CompiledPreferences.from_csv(tmp_path / 'proposers.tsv', tmp_path / 'receivers.tsv', delimiter='\t',
+                                            chunk_size=2)
+    model = MarriageModel.from_compiled(compiled)
+    assert dict(model.proposers) == proposers and dict(model.receivers) == receivers
+    assert pairs(model.Deferred_Acceptance(), proposers) == expected
+
+    # the same profile as .npy files of integer ids
+    for side in (0, 1):
+        np.save(tmp_path / '{}.npy'.format(side), compiled.preferences[side])
+    compiled = CompiledPreferences.from_npy(tmp_path / '0.npy', tmp_path / '1.npy', list(proposers), list(receivers))
+    assert isinstance(compiled.preferences[0], np.memmap)
+    assert pairs(MarriageModel.from_compiled(compiled).Deferred_Acceptance(), proposers) == expected
+
+    MarriageModel.from_compiled(compiled).save_compiled(tmp_path / 'saved')
+    model = MarriageModel.load_compiled(tmp_path / 'saved')
+    for name in ('preferences', 'lengths', 'rank_tables'):
+        for side in (0, 1):
+            assert np.array_equal(getattr(model.compiled, name)[side], getattr(compiled, name)[side])
+    assert model.compiled.labels == compiled.labels
+    assert pairs(model.Deferred_Acceptance(), proposers) == expected
+
+
+def test_compiled_preferences_are_checked(tmp_path):
+    with pytest.raises(ValueError):
+        CompiledPreferences.from_arrays((['m0'], ['w0']), (np.array([[1]]), np.array([[0]])))
+    with pytest.raises(ValueError):
+        CompiledPreferences.from_arrays((['m0'], ['w0', 'w1']), (np.array([[-1, 0]]), np.array([[0], [0]])))
+    with pytest.raises(ValueError):
+        CompiledPreferences.from_arrays((['m0'], ['w0', 'w1']), (np.array([[1, 1]]), np.array([[0], [0]])))
+    write_csv(tmp_path / 'proposers.csv', {'m0': ['w0'], 'm1': ['w1']})
+    write_csv(tmp_path / 'receivers.csv', {'w0': ['m0']})
+    with pytest.raises(ValueError):
+        CompiledPreferences.from_csv(tmp_path / 'proposers.csv', tmp_path / 'receivers.csv')
+    # (the labels are saved as JSON)
+    with pytest.raises(ValueError):
+        MarriageModel({('m', 0): ['w0']}, {'w0': [('m', 0)]}, compiled=True).save_compiled(tmp_path / 'saved')
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_sparse_preferences_agree_with_dense_preferences(seed):
+    proposers, receivers = MARKETS[seed]
+    rng = random.Random(seed)
+    dense = MarriageModel(proposers, receivers, compiled=True)
+    sparse = MarriageModel(proposers, receivers, compiled='sparse')
+    assert isinstance(sparse.compiled, SparsePreferences)
+    assert pairs(sparse.Deferred_Acceptance(), proposers) == dict_deferred_acceptance(proposers, receivers)
+    for mu in [dense.Deferred_Acceptance()] + [random_matching(rng, proposers, receivers) for _ in range(10)]:
+        assert outcome(sparse, dict(mu)) == outcome(dense, dict(mu))
+        assert sparse.audit_stability(mu) == dense.audit_stability(mu)
+    # (both forms take the same random path for the same seed)
+    support, frequencies = sparse.random_path_to_stability(5, seed=seed)
+    dense_support, dense_frequencies = dense.random_path_to_stability(5, seed=seed)
+    assert support == dense_support and np.array_equal(frequencies, dense_frequencies)
+    # (the queue engine walks the rank tables, which the sparse form does not have)
+    with pytest.raises(ValueError):
+        sparse.Deferred_Acceptance(engine='queue')
+
+
+def test_npy_labels_are_not_on_both_sides(tmp_path):
+    proposers, receivers = MARKETS[1]
+    compiled = MarriageModel(proposers, receivers, compiled=True).compiled
+    for side in (0, 1):
+        np.save(tmp_path / '{}.npy'.format(side), compiled.preferences[side])
+    for kind in (CompiledPreferences, SparsePreferences):
+        model = MarriageModel.from_compiled(kind.from_npy(tmp_path / '0.npy', tmp_path / '1.npy'))
+        assert not set(model.proposers) & set(model.receivers)
+        mu = model.Deferred_Acceptance()
+        assert {('m{}'.format(p), 'w{}'.format(r - len(proposers))) for p, r in pairs(mu, model.proposers)} == \
+            dict_deferred_acceptance(proposers, receivers)
+
+
+@pytest.mark.parametrize('compiled', [True, 'sparse'])
+@pytest.mark.parametrize('seed', range(5))
+def test_saved_models_load_in_the_form_they_were_saved_in(compiled, seed, tmp_path):
+    proposers, receivers = MARKETS[seed]
+    model = MarriageModel(proposers, receivers, compiled=compiled)
+    model.save_compiled(tmp_path / 'saved')
+    for mmap_mode in ('r', None):
+        loaded = MarriageModel.load_compiled(tmp_path / 'saved', mmap_mode=mmap_mode)
+        assert type(loaded.compiled) is type(model.compiled)
+        assert loaded.compiled.labels == model.compiled.labels
+        for name in type(model.compiled)._arrays:
+            for side in (0, 1):
+                assert np.array_equal(getattr(loaded.compiled, name)[side], getattr(model.compiled, name)[side])
+        assert pairs(loaded.Deferred_Acceptance(), proposers) == dict_deferred_acceptance(proposers, receivers)
+    # (the class load() is called on does not matter)
+    assert type(SparsePreferences.load(tmp_path / 'saved')) is type(model.compiled)
+
+
+# the proposals Deferred Acceptance makes: every proposer proposes down their list to their partner, and a single
+# proposer proposes to everyone on their list
+def number_of_proposals(proposers, matched):
+    partner = dict(matched)
+    return sum(choices.index(partner[p]) + 1 if p in partner else len(choices) for p, choices in proposers.items())
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('compiled, engine', [(False, 'rounds'), (True, 'rounds'), (True, 'queue'),
+                                              ('sparse', 'rounds')])
+def test_observed_rounds_add_up_to_the_run_stats(seed, compiled, engine, capsys):
+    proposers, receivers = MARKETS[seed]
+    model = MarriageModel(proposers, receivers, compiled=compiled)
+    recorder = RoundRecorder()
+    matched = pairs(model.Deferred_Acceptance(engine=engine, observer=recorder, print_rounds=True), proposers)
+    stats = model.stats
+    assert stats.method == 'Deferred_Acceptance'
+    assert 'ran {} rounds'.format(stats.rounds) in capsys.readouterr().out
+    events = recorder.as_arrays()
+    assert events['round'].tolist() == list(range(1, len(recorder.events) + 1))
+    assert events['proposals'].sum() == stats.proposals == number_of_proposals(proposers, matched)
+    assert events['rejections'].sum() == stats.rejections == stats.proposals - len(matched)
+    assert events['free_proposers'][-1] == 0 and stats.seconds >= events['seconds'].sum() >= 0
+
+
+def test_observed_rounds_with_capacities():
+    proposers, receivers, capacities, slots, cloned = capacitated_market(3)
+    model = MarriageModel(proposers, receivers, capacities=capacities)
+    recorder = RoundRecorder()
+    assignment = model.Deferred_Acceptance(observer=recorder)
+    matched = [(p, r) for r in receivers for p in assignment[r]]
+    assert sum(event.proposals for event in recorder.events) == model.stats.proposals == \
+        number_of_proposals(proposers, matched)
+    assert sum(event.rejections for event in recorder.events) == model.stats.rejections == \
+        model.stats.proposals - len(matched)
+
+
+def test_observed_random_paths_and_json_lines():
+    model = MarriageModel(*LATIN_SQUARE)
+    recorder = RoundRecorder()
+    stream = io.StringIO()
+    model.random_path_to_stability(5, seed=0, observer=lambda event: (recorder(event), JSONLinesLogger(stream)(event)))
+    # (a step of a random path is a round with one proposal, the blocking pair)
+    assert model.stats.method == 'random_path_to_stability'
+    assert len(recorder.events) == model.stats.proposals == sum(event.proposals for event in recorder.events)
+    assert sum(event.rejections for event in recorder.events) == model.stats.rejections
+    assert [json.loads(line) for line in stream.getvalue().splitlines()] == [e._asdict() for e in recorder.events]
+    # (the events of the paths of several workers cannot be put in order)
+    with pytest.raises(ValueError):
+        model.random_path_to_stability(5, seed=0, n_jobs=2, observer=recorder)
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_patience_stops_the_lottery_early(compiled):
+    # with a single stable matching, the lottery stops after the first path and patience more
+    model = MarriageModel(*MARKETS[1], compiled=compiled)
+    _, frequencies = model.random_path_to_stability(1000, seed=0, patience=5)
+    assert frequencies.tolist() == [6]
+
+    # the paths drawn before the stop are the first paths of the lottery without patience
+    model = MarriageModel(*LATIN_SQUARE, compiled=compiled)
+    support, frequencies = model.random_path_to_stability(1000, seed=3, patience=10)
+    draws = int(frequencies.sum())
+    assert len(support) == 3 and draws < 1000
+    for n_jobs in (1, 2):
+        other, other_frequencies = model.random_path_to_stability(1000, seed=3, patience=10, n_jobs=n_jobs)
+        assert other == support and np.array_equal(other_frequencies, frequencies)
+    full_support, full_frequencies = model.random_path_to_stability(draws, seed=3)
+    assert full_support == support and np.array_equal(full_frequencies, frequencies)
+
+    for patience in (0, 1.5):
+        with pytest.raises(ValueError):
+            model.random_path_to_stability(10, seed=0, patience=patience)
+
+
+def test_module_compiles_without_warnings():
+    with open(StableMarriage.__file__) as file:
+        source = file.read()
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        compile(source, StableMarriage.__file__, 'exec')
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_matching_agrees_with_the_dictionary_it_replaces(seed):
+    proposers, receivers = MARKETS[seed]
+    expected = MarriageModel(proposers, receivers).Deferred_Acceptance()
+    model = MarriageModel(proposers, receivers, compiled=True)
+    mu = model.Deferred_Acceptance()
+    assert isinstance(mu, Matching)
+    assert mu == expected and type(mu.copy()) is dict and mu.copy() == expected and repr(mu) == repr(mu.copy())
+    # (the proposers come first, in order, followed by the unmatched receivers)
+    assert list(mu) == list(proposers) + [r for r in receivers if r in expected]
+    assert mu == model.Deferred_Acceptance(engine='queue')
+    assert model.is_stable(mu) is True and model.audit_stability(mu)['stable']
+
+    partner = {p: r for p, r in expected.items() if p in proposers}
+    partner.update([(r, p) for p, r in partner.items() if r is not None])
+    for agent in list(proposers) + list(receivers):
+        assert mu.partner_of(agent) == partner.get(agent)
+    with pytest.raises(ValueError):
+        mu.partner_of('nobody')
+    # (a matched receiver is not a key, as in the dictionary)
+    for r in receivers:
+        assert (r in mu) == (partner.get(r) is None)
+
+    matched = [(p, partner[p]) for p in proposers if partner[p] is not None]
+    assert mu.pairs() == matched
+    assert mu.unmatched(0) == [p for p in proposers if partner[p] is None]
+    assert mu.unmatched(1) == [r for r in receivers if partner.get(r) is None]
+    for side, profile in enumerate((proposers, receivers)):
+        assert mu.ranks(side).tolist() == [choices.index(partner[a]) if partner.get(a) is not None else len(choices)
+                                           for a, choices in profile.items()]
+    proposer_ranks = [proposers[p].index(r) for p, r in matched]
+    receiver_ranks = [receivers[r].index(p) for p, r in matched]
+    statistics = mu.rank_statistics()
+    assert statistics['number_of_pairs'] == len(matched)
+    assert (statistics['proposer_rank_sum'], statistics['receiver_rank_sum']) == (sum(proposer_ranks),
+                                                                                  sum(receiver_ranks))
+    assert statistics['egalitarian_cost'] == sum(ranks(matched, proposers, receivers))
+    assert statistics['regret'] == max(proposer_ranks + receiver_ranks, default=-1)
+
+
+def test_compiled_rotation_methods_return_matchings():
+    model = MarriageModel(*LATIN_SQUARE, compiled=True)
+    matchings = list(model.all_stable_matchings())
+    assert all(isinstance(mu, Matching) for mu in matchings) and len(matchings) == 3
+    assert isinstance(model.optimal_stable_matching(), Matching)
+    assert matchings[0] == model.Deferred_Acceptance() and matchings[1] != matchings[0]
+
+
+@pytest.mark.parametrize('compiled', [True, 'sparse'])
+@pytest.mark.parametrize('n_jobs', [1, 2, 3])
+def test_parallel_engine_agrees_with_the_rounds_engine(compiled, n_jobs, monkeypatch):
+    # every round goes through the worker processes, however few proposals it has
+    monkeypatch.setattr(StableMarriage._RoundWorkers, 'min_proposals', 1)
+    for proposers, receivers in MARKETS[:6]:
+        model = MarriageModel(proposers, receivers, compiled=compiled)
+        serial, parallel = RoundRecorder(), RoundRecorder()
+        expected = model.Deferred_Acceptance(observer=serial)
+        expected_stats = model.stats
+        mu = model.Deferred_Acceptance(engine='parallel', n_jobs=n_jobs, observer=parallel)
+        assert mu == expected and pairs(mu, proposers) == dict_deferred_acceptance(proposers, receivers)
+        assert model.stats.engine == 'parallel'
+        assert model.stats[2:5] == expected_stats[2:5]
+        assert [event[:4] for event in parallel.events] == [event[:4] for event in serial.events]
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('method', ['pairs', 'agents'])
+def test_estimate_stability_agrees_with_the_audit(seed, method):
+    proposers, receivers = MARKETS[seed]
+    model = MarriageModel(proposers, receivers, compiled=True)
+    stable = model.estimate_stability(model.Deferred_Acceptance(), method=method, seed=seed)
+    assert stable['estimate'] == 0 and stable['blocking_pair'] is None and stable['number_of_blocking_pairs'] == 0
+    assert stable['converged'] and stable['interval'][0] == 0
+
+    mu = random_matching(random.Random(seed), proposers, receivers)
+    blocking = brute_force_blocking_pairs(mu, proposers, receivers)
+    if method == 'pairs':
+        share = len(blocking) / (len(proposers) * len(receivers))
+    else:
+        share = len({p for p, _ in blocking}) / len(proposers)
+    estimate = model.estimate_stability(mu, method=method, confidence=0.999, tolerance=0.005, seed=seed)
+    assert estimate['method'] == method and estimate['converged']
+    assert estimate['interval'][0] <= share <= estimate['interval'][1]
+    assert abs(estimate['estimate'] - share) <= 0.005
+    assert (estimate['blocking_pair'] in blocking) if blocking else estimate['blocking_pair'] is None
+    if method == 'pairs':
+        assert estimate['number_of_blocking_pairs'] == pytest.approx(len(blocking), abs=0.005 * len(proposers)
+                                                                     * len(receivers))
+    # (the same seed draws the same sample)
+    again = model.estimate_stability(mu, method=method, confidence=0.999, tolerance=0.005, seed=seed)
+    assert {k: v for k, v in again.items() if k != 'seconds'} == {k: v for k, v in estimate.items() if k != 'seconds'}
+
+
+def test_estimate_stability_stopping_rules_and_capacities():
+    proposers, receivers, capacities, slots, cloned = capacitated_market(0)
+    model = MarriageModel(proposers, receivers, capacities=capacities)
+    assignment = random_assignment(random.Random(0), proposers, receivers, capacities)
+    assert model.is_stable(assignment) is not True
+    estimate = model.estimate_stability(assignment, max_samples=100, tolerance=0, seed=0, batch_size=10)
+    assert estimate['samples'] == 100 and not estimate['converged']
+    assert estimate['blocking_pair'] in set(model.audit_stability(assignment)['blocking_pairs'])
+    with pytest.raises(ValueError):
+        model.estimate_stability(assignment, method='receivers')
+    with pytest.raises(ValueError):
+        model.estimate_stability(assignment, confidence=1)
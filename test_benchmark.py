@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+import benchmark
+from StableMarriage import CompiledPreferences, MarriageModel
+
+GENERATORS = [benchmark.uniform, benchmark.truncated, benchmark.master_list, benchmark.mallows]
+
+
+# every row lists distinct ids of the other side, padded with -1 at the end
+def check_padded(preferences, number_of_others):
+    listed = preferences >= 0
+    assert not np.any(~listed[:, :-1] & listed[:, 1:])
+    assert np.all(preferences < number_of_others)
+    for row in preferences:
+        assert len(set(row[row >= 0].tolist())) == np.count_nonzero(row >= 0)
+
+
+@pytest.mark.parametrize('generate', GENERATORS)
+@pytest.mark.parametrize('number_of_proposers, number_of_receivers', [(12, 12), (15, 9), (9, 15)])
+def test_generators(generate, number_of_proposers, number_of_receivers):
+    proposers, receivers = generate(number_of_proposers, number_of_receivers, seed=3)
+    assert len(proposers) == number_of_proposers and len(receivers) == number_of_receivers
+    check_padded(proposers, number_of_receivers)
+    check_padded(receivers, number_of_proposers)
+    # (the same seed gives the same market)
+    again = generate(number_of_proposers, number_of_receivers, seed=3)
+    assert np.array_equal(proposers, again[0]) and np.array_equal(receivers, again[1])
+
+
+@pytest.mark.parametrize('number_of_receivers, ratio, number_of_proposers',
+                         [(10, 1.1, 11), (20, 1.1, 22), (5, 1.5, 8), (4, 1.0, 5)])
+def test_unbalanced_markets(number_of_receivers, ratio, number_of_proposers):
+    proposers, receivers = benchmark.unbalanced(number_of_receivers, ratio, seed=0)
+    assert proposers.shape == (number_of_proposers, number_of_receivers)
+    assert receivers.shape == (number_of_receivers, number_of_proposers)
+    check_padded(proposers, number_of_receivers)
+    check_padded(receivers, number_of_proposers)
+    # every receiver is matched, and the proposers left over stay single after proposing to every receiver
+    profiles = benchmark.to_profiles(proposers, receivers)
+    mu = MarriageModel(*profiles).Deferred_Acceptance()
+    assert sum(mu[p] is None for p in profiles[0]) == number_of_proposers - number_of_receivers
+
+
+def test_generator_parameters():
+    proposers, receivers = benchmark.truncated(20, 30, length=4, seed=0)
+    assert proposers.shape == (20, 4) and receivers.shape == (30, 4)
+    # without noise or dispersion, everyone on a side has the same list
+    for proposers, receivers in (benchmark.master_list(10, 10, noise=0, seed=0),
+                                 benchmark.mallows(10, 10, dispersion=0, seed=0)):
+        assert np.all(proposers == proposers[0]) and np.all(receivers == receivers[0])
+
+
+def test_profiles_and_arrays_give_the_same_market():
+    preferences = benchmark.truncated(12, 10, length=5, seed=1)
+    profiles = benchmark.to_profiles(*preferences)
+    compiled = CompiledPreferences.from_profile(*profiles)
+    for side in (0, 1):
+        assert np.array_equal(compiled.preferences[side], preferences[side])
+    model = MarriageModel.from_compiled(CompiledPreferences.from_arrays((list(profiles[0]), list(profiles[1])),
+                                                                        preferences))
+    assert model.Deferred_Acceptance() == MarriageModel(*profiles).Deferred_Acceptance()
+
+
+def test_run_save_and_compare(tmp_path):
+    results = benchmark.run(sizes=(8,), repeat=1)
+    sizes = {(r['scenario'], r['number_of_proposers'], r['number_of_receivers']) for r in results}
+    assert sizes == {(scenario, 8, 8) for scenario in benchmark.SCENARIOS if scenario != 'unbalanced'} | \
+        {('unbalanced', 9, 8)}
+    assert {(r['scenario'], r['method']) for r in results} == {(scenario, method) for scenario in benchmark.SCENARIOS
+                                                               for method in benchmark.METHODS}
+    for scenario in benchmark.SCENARIOS:
+        solved = [r for r in results if r['scenario'] == scenario and r['method'].startswith('Deferred_Acceptance')]
+        # (every engine makes the same proposals)
+        assert len({r['proposals'] for r in solved}) == 1 and solved[0]['proposals'] >= 8
+        assert all(r['rounds'] >= 1 for r in solved)
+    assert all(r['seconds'] >= 0 and r['peak_memory'] > 0 for r in results)
+
+    benchmark.save(results, tmp_path / 'before.json')
+    compared = benchmark.compare(tmp_path / 'before.json', tmp_path / 'before.json')
+    assert len(compared) == len(results) and all(ratio == 1 for *_, ratio in compared)
+    with pytest.raises(ValueError):
+        benchmark.run(sizes=(8,), methods=['Deferred_Acceptance[stack]'])